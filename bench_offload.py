@@ -0,0 +1,62 @@
+"""
+Benchmark of offload.dumps against inline json encoding, by result size.
+
+Reports, per size: inline json.dumps time, offloaded round trip time,
+and the time the calling thread holds the GIL to pickle the result
+for the pool (what other request threads still wait on). Offloading
+only pays off once pickling is well under inline encoding.
+
+Run from the project root:
+	python -m cts_app.cts_api.bench_offload
+"""
+
+import json
+import pickle
+import timeit
+
+from . import offload
+
+
+
+bench_sizes = [1000, 5000, 20000, 100000, 400000]
+
+
+
+def metabolizer_result(item_count):
+	"""
+	Metabolizer-like tree with p-chem on each product,
+	about item_count containers and values in all.
+	"""
+	def _node(i):
+		return {
+			'id': i,
+			'data': {
+				'smiles': "CCC(=O)OCC{}".format(i),
+				'routes': "hydrolysis",
+				'generation': i % 4,
+				'likelihood': "LIKELY",
+				'pchem': {'chemaxon': {'water_sol': {'valid': True, 'data': 1234.5 + i, 'method': None}}}
+			},
+			'children': []
+		}
+	items_per_node = offload.count_items(_node(0), limit=1000)
+	return {'data': [_node(i) for i in range(max(item_count // items_per_node, 1))]}
+
+
+def run_bench(number=5):
+	results = []
+	for size in bench_sizes:
+		obj = metabolizer_result(size)
+		inline = timeit.timeit(lambda: json.dumps(obj).encode('utf-8'), number=number) / number
+		pickling = timeit.timeit(lambda: pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL), number=number) / number
+		offload.get_executor().submit(offload._dumps_bytes, obj).result()  # warm up workers
+		pooled = timeit.timeit(lambda: offload.get_executor().submit(offload._dumps_bytes, obj).result(), number=number) / number
+		results.append((offload.count_items(obj, limit=10 ** 9), inline * 1000, pooled * 1000, pickling * 1000))
+	return results
+
+
+
+if __name__ == '__main__':
+	print("{:>9} {:>12} {:>12} {:>16}".format("items", "inline ms", "pool ms", "caller pickle ms"))
+	for items, inline, pooled, pickling in run_bench():
+		print("{:>9} {:>12.2f} {:>12.2f} {:>16.2f}".format(items, inline, pooled, pickling))
@@ -0,0 +1,47 @@
+"""
+Microbenchmark of per-request decoding overhead for /{calc}/run.
+
+Run from the project root:
+	python -m cts_app.cts_api.bench_request_decoding
+"""
+
+import json
+import timeit
+
+from .request_decoding import decode_run_request
+
+
+
+bench_bodies = {
+	'pchem': json.dumps({'chemical': "CC(=O)Oc1ccccc1C(=O)O", 'calc': "chemaxon", 'prop': "kow_wph", 'ph': 7.0, 'run_type': "rest"}),
+	'pchem_swagger_backslash': '{"chemical": "C/C=C\\C(=O)O", "calc": "epi", "prop": "water_sol"}',
+	'metabolizer': json.dumps({'structure': "CCC(=O)OCC", 'generationLimit': 2, 'transformationLibraries': ["hydrolysis", "abiotic_reduction"], 'pchemProps': {'chemaxon': ["water_sol"]}}),
+}
+
+
+
+class BenchRequest(object):
+	"""
+	Minimal stand-in for django's HttpRequest.
+	"""
+	def __init__(self, body):
+		self.body = body.encode('utf-8')
+		self.META = {'CONTENT_TYPE': "application/json"}
+		self.POST = {}
+
+
+
+def run_bench(number=20000):
+	results = {}
+	for name, body in bench_bodies.items():
+		request = BenchRequest(body)
+		calc = 'metabolizer' if name == 'metabolizer' else 'chemaxon'
+		seconds = timeit.timeit(lambda: decode_run_request(request, calc), number=number)
+		results[name] = seconds / number * 1e6
+	return results
+
+
+
+if __name__ == '__main__':
+	for name, microseconds in run_bench().items():
+		print("{:<28} {:8.2f} us/request".format(name, microseconds))
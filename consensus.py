@@ -0,0 +1,129 @@
+"""
+Cross-calculator consensus p-chem statistics.
+
+Gathers each calculator/method's value for a batch of chemicals
+through CTS_REST.runPchemCalc, then computes per-prop statistics
+and outlier flags over the whole chemical x source matrix with NumPy.
+"""
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .pchem_export import export_schema, iter_export_rows
+from .request_timing import with_current_timer
+
+
+
+consensus_workers = int(os.environ.get('CTS_CONSENSUS_WORKERS', 8))
+outlier_threshold = 3.5  # modified z-score (Iglewicz and Hoaglin)
+consensus_calcs = ['chemaxon', 'epi', 'test', 'opera']
+
+
+
+def to_number(value, units):
+	"""
+	Returns value as a float in consensus units (log for
+	partition coefficients), or NaN if it isn't numeric.
+	"""
+	try:
+		number = float(value)
+	except (TypeError, ValueError):
+		return np.nan
+	if units == 'L/kg':
+		return np.log10(number) if number > 0 else np.nan
+	return number
+
+
+def consensus_units(units):
+	return 'log' if units == 'L/kg' else units
+
+
+def gather_values(cts_rest_obj, chemicals, calcs, props, ph=None):
+	"""
+	Returns {prop: {'sources': [...], 'units': str, 'values': 2d array}},
+	with a row per chemical and column per calc/method source.
+	"""
+	schema = export_schema(cts_rest_obj, calcs, props)
+
+	def _chemical_rows(chemical):
+		return list(iter_export_rows(cts_rest_obj, [chemical], schema, ph))
+
+	with ThreadPoolExecutor(max_workers=consensus_workers) as executor:
+		chemical_rows = list(executor.map(with_current_timer(_chemical_rows), chemicals))
+
+	prop_data = {}
+	for row_index, rows in enumerate(chemical_rows):  # by position, chemicals can repeat
+		for chemical, calc, prop, method, value, units, error in rows:
+			source = "{} {}".format(calc, method).strip()
+			prop_obj = prop_data.setdefault(prop, {'sources': [], 'units': consensus_units(units), 'cells': []})
+			if consensus_units(units) != prop_obj['units']:
+				logging.warning("skipping {} {}: units {} don't match {}".format(source, prop, units, prop_obj['units']))
+				continue
+			if source not in prop_obj['sources']:
+				prop_obj['sources'].append(source)
+			prop_obj['cells'].append((row_index, prop_obj['sources'].index(source), to_number(value, units)))
+
+	for prop, prop_obj in prop_data.items():
+		values = np.full((len(chemicals), len(prop_obj['sources'])), np.nan)
+		for row, col, number in prop_obj.pop('cells'):
+			values[row, col] = number
+		prop_obj['values'] = values
+	return prop_data
+
+
+def consensus_stats(values):
+	"""
+	Per-row statistics over a chemical x source matrix, ignoring NaNs.
+	Returns dict of 1d arrays, plus a 2d boolean outlier mask.
+	"""
+	counts = np.sum(~np.isnan(values), axis=1)
+	has_values = counts > 0
+	stats = {'n': counts}
+	with np.errstate(invalid='ignore', divide='ignore'):
+		safe_values = np.where(has_values[:, None], values, 0.0)  # avoids all-NaN row warnings
+		stats['mean'] = np.where(has_values, np.nanmean(safe_values, axis=1), np.nan)
+		stats['median'] = np.where(has_values, np.nanmedian(safe_values, axis=1), np.nan)
+		stats['std'] = np.where(has_values, np.nanstd(safe_values, axis=1), np.nan)
+		stats['min'] = np.where(has_values, np.nanmin(safe_values, axis=1), np.nan)
+		stats['max'] = np.where(has_values, np.nanmax(safe_values, axis=1), np.nan)
+		deviations = np.abs(values - stats['median'][:, None])
+		mad = np.where(has_values, np.nanmedian(np.where(has_values[:, None], deviations, 0.0), axis=1), np.nan)
+		modified_z = 0.6745 * deviations / mad[:, None]
+	stats['outliers'] = (mad[:, None] > 0) & (modified_z > outlier_threshold)
+	return stats
+
+
+def _json_number(number):
+	return None if np.isnan(number) else round(float(number), 6)
+
+
+def run_consensus(cts_rest_obj, chemicals, props, calcs=None, ph=None, aggregates_only=False):
+	"""
+	Returns consensus response data: per prop, a list of per-chemical
+	aggregates, plus each source's value unless aggregates_only.
+	"""
+	prop_data = gather_values(cts_rest_obj, chemicals, calcs or consensus_calcs, props, ph)
+	results = {}
+	for prop, prop_obj in prop_data.items():
+		values, sources = prop_obj['values'], prop_obj['sources']
+		stats = consensus_stats(values)
+		chemical_results = []
+		for i, chemical in enumerate(chemicals):
+			chemical_result = {
+				'chemical': chemical,
+				'n': int(stats['n'][i]),
+				'mean': _json_number(stats['mean'][i]),
+				'median': _json_number(stats['median'][i]),
+				'std': _json_number(stats['std'][i]),
+				'min': _json_number(stats['min'][i]),
+				'max': _json_number(stats['max'][i]),
+				'outliers': [sources[j] for j in np.flatnonzero(stats['outliers'][i])]
+			}
+			if not aggregates_only:
+				chemical_result['values'] = {source: _json_number(values[i, j]) for j, source in enumerate(sources)}
+			chemical_results.append(chemical_result)
+		results[prop] = {'units': prop_obj['units'], 'sources': sources, 'chemicals': chemical_results}
+	return results
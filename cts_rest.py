@@ -10,7 +10,7 @@ import json
 import datetime
 import pytz
 
-from django.http import HttpResponse, HttpRequest
+from django.http import HttpResponse, HttpRequest, StreamingHttpResponse
 from django.template.loader import render_to_string
 
 from ..cts_calcs.calculator_chemaxon import JchemCalc
@@ -28,12 +28,25 @@ from ..cts_calcs.chemical_information import ChemInfo
 from ..cts_calcs.mongodb_handler import MongoDBHandler
 from ..cts_calcs.calculator_pkasolver import PkaSolverCalc
 from ..cts_calcs.calculator_molgpka import MolgpkaCalc
+from .structure_index import structure_index, is_cacheable_result, restore_request_fields
+from .result_freshness import result_freshness, refresh_in_background
+from .results_pack import get_results_pack, pack_calcs
+from .micro_batch import supports_batching, batched_request
+from .request_timing import phase
+from . import offload
+from .offload import run_cpu_bound
+from .pchem_postprocess import select_epi_prop, select_measured_prop
+from .metabolizer_pchem import run_product_pchem, validate_pchem_props
+from .metabolizer_graph import build_dag, stream_dag_response
 
 
 
 db_handler = MongoDBHandler()
 chem_info_obj = ChemInfo()
 
+# Public calc names that run under a different calc in runPchemCalc:
+run_calc_names = {'test': 'testws'}
+
 
 
 class CTS_REST(object):
@@ -110,7 +123,7 @@ class CTS_REST(object):
 			}
 		]
 		self.pchem_inputs = ['chemical', 'calc', 'prop', 'run_type']
-		self.metabolizer_inputs = ['structure', 'generationLimit', 'transformationLibraries']
+		self.metabolizer_inputs = ['structure', 'generationLimit', 'transformationLibraries', 'pchemProps', 'responseFormat']
 
 	@classmethod
 	def getCalcObject(self, calc):
@@ -184,6 +197,185 @@ class CTS_REST(object):
 			})
 		return HttpResponse(json.dumps(_response), content_type="application/json")
 
+	def getModelVersion(self, calc):
+		"""
+		Gets calc's modelVersion from its meta info, used to
+		invalidate stored results after a backend upgrade.
+		"""
+		try:
+			meta_info = getattr(self.getCalcObject(calc), 'meta_info', None) or {}
+			return meta_info.get('metaInfo', meta_info).get('modelVersion') or None
+		except Exception as e:
+			logging.warning("cannot get {} model version: {}".format(calc, e))
+			return None
+
+	def backendRequest(self, calc, calc_obj, request_dict):
+		"""
+		Makes calc_obj's backend request, through its micro-batcher
+		if it's enabled for calc (see micro_batch.py), timed as the
+		backend phase.
+		"""
+		with phase('backend'):
+			if supports_batching(calc, calc_obj):
+				return batched_request(calc, calc_obj, request_dict)
+			return calc_obj.data_request_handler(request_dict)
+
+	def getPackedResult(self, results_pack, calc, request_dict, model_version, filtered=True):
+		"""
+		Gets packed result for request_dict's chemical through the
+		pack's aliases, or None. An unfiltered chemical gets the
+		filtered smiles the pack was built with, as from SMILESFilter.
+		"""
+		alias = results_pack.get_alias(request_dict.get('chemical'))
+		if not alias:
+			return None
+		packed_data = results_pack.lookup(alias['key'], calc, request_dict, model_version)
+		if packed_data is None:
+			return None
+		if not filtered:
+			request_dict.update({
+				'orig_smiles': request_dict.get('chemical'),
+				'chemical': alias['smiles'],
+			})
+		logging.info("Getting {} p-chem from results pack.".format(calc))
+		return restore_request_fields(packed_data, request_dict)
+
+	def runPchemCalc(self, calc, request_dict, use_cache=True):
+		"""
+		Runs a p-chem calculator for a single chemical/prop.
+		Returns (pchem_data, error_obj), with error_obj set if
+		the calculator returned an invalid response.
+
+		Precomputed results (results_pack.py) and stored results, fresh
+		or stale (refreshed in the background, see result_freshness.py),
+		are served first; use_cache=False skips them.
+		"""
+		calc = run_calc_names.get(calc, calc)
+		if request_dict.get('calc') in run_calc_names:
+			request_dict['calc'] = calc
+		model_version = self.getModelVersion(calc)
+		results_pack = get_results_pack() if use_cache and calc in pack_calcs else None
+
+		if results_pack:
+			with phase('cache'):
+				# chemicals the pack was built from skip the smiles filter and structure index:
+				packed_data = self.getPackedResult(results_pack, calc, request_dict, model_version, filtered=False)
+				if packed_data is not None:
+					return packed_data, None
+
+		with phase('smiles_filter'):
+			try:
+				_orig_smiles = request_dict.get('chemical')
+				_filtered_smiles = SMILESFilter().filterSMILES(_orig_smiles)
+				request_dict.update({
+					'orig_smiles': _orig_smiles,
+					'chemical': _filtered_smiles,
+				})
+			except Exception as e:
+				logging.warning("exception in cts_rest.py runCalc: {}".format(e))
+				logging.warning("skipping SMILES filter..")
+
+		with phase('cache'):
+			if results_pack and request_dict.get('chemical') != request_dict.get('orig_smiles'):
+				packed_data = self.getPackedResult(results_pack, calc, request_dict, model_version, filtered=True)
+				if packed_data is not None:
+					return packed_data, None
+			canonical_key = structure_index.resolve(request_dict.get('orig_smiles'), request_dict.get('chemical'))
+			if results_pack:
+				packed_data = results_pack.lookup(canonical_key, calc, request_dict, model_version)
+				if packed_data is not None:
+					logging.info("Getting {} p-chem from results pack.".format(calc))
+					return restore_request_fields(packed_data, request_dict), None
+			if use_cache:
+				cached_entry = structure_index.get_result(canonical_key, calc, request_dict)
+				freshness = result_freshness(calc, cached_entry, model_version)
+				if freshness != 'expired':
+					logging.info("Getting {} p-chem from structure index ({}).".format(calc, freshness))
+					if freshness == 'stale':
+						refresh_key = structure_index.result_key(canonical_key, calc, request_dict)
+						refresh_in_background(refresh_key, self.runPchemCalc, calc, dict(request_dict), use_cache=False)
+					return restore_request_fields(cached_entry['data'], request_dict), None
+
+		pchem_data = {}
+		if calc == 'chemaxon':
+			pchem_data = self.backendRequest(calc, JchemCalc(), request_dict)
+		elif calc == 'epi':
+			_epi_calc = EpiCalc()
+			pchem_data = self.backendRequest(calc, _epi_calc, request_dict)
+			if not pchem_data.get('valid'):
+				logging.warning("{} request error: {}".format(calc, pchem_data))
+				_response_obj = {'error': pchem_data.get('data')}
+				_response_obj.update(request_dict)
+				return pchem_data, _response_obj
+			# with updated epi, have to pick out desired prop:
+			epi_prop_name = _epi_calc.propMap[request_dict['prop']]['result_key']
+
+			if epi_prop_name == "qsar":
+				return pchem_data, None
+
+			with phase('postprocess'):
+				_epi_methods = _epi_calc.propMap.get(request_dict['prop']).get('methods') or {}
+				pchem_data = run_cpu_bound(select_epi_prop, pchem_data, request_dict['prop'], epi_prop_name, _epi_methods)
+
+		elif calc == 'testws':
+			pchem_data = self.backendRequest(calc, TestWSCalc(), request_dict)
+
+		elif calc == 'sparc':
+			pchem_data = self.backendRequest(calc, SparcCalc(), request_dict)
+			
+		elif calc == 'measured':
+			pchem_data = self.backendRequest(calc, MeasuredCalc(), request_dict)
+			if not pchem_data.get('valid'):
+				logging.warning("{} request error: {}".format(calc, pchem_data))
+				_response_obj = {'error': pchem_data.get('data')}
+				_response_obj.update(request_dict)
+				return pchem_data, _response_obj
+			# with updated measured, have to pick out desired prop:
+			with phase('postprocess'):
+				measured_prop_name = MeasuredCalc().propMap[request_dict['prop']]['result_key']
+				pchem_data = run_cpu_bound(select_measured_prop, pchem_data, request_dict['prop'], measured_prop_name)
+
+		elif calc == 'opera':
+
+			opera_calc = OperaCalc()
+
+			try:
+
+				db_results = opera_calc.check_opera_db(request_dict)  # checks db for pchem data
+				if not db_results:
+					logging.info("Running OPERA model.")
+					pchem_data = self.backendRequest(calc, opera_calc, request_dict)
+				else:
+					with phase('postprocess'):
+						logging.info("Getting OPERA p-chem from database.")
+						pchem_data = {'valid': True, 'request_post': request_dict, 'data': []}
+						db_results = opera_calc.curate_logd(db_results, request_dict, request_dict.get('ph'))
+						pchem_data['data'] = self.wrap_db_results(request_dict, db_results, request_dict.get('props'))
+						pchem_data['data'] = opera_calc.remove_opera_db_duplicates(pchem_data['data'])
+						logging.info("Getting p-chem data from DB.")
+						del db_results['_id']
+						pchem_data = {'status': True, 'request_post': request_dict, 'data': db_results}
+						pchem_data['data'].update(request_dict)
+						pchem_data['data'] = opera_calc.convert_units_for_cts(request_dict['prop'], pchem_data['data'])
+
+			except Exception as e:
+				logging.warning("Error requesting opera data: {}".format(e))
+				db_handler.mongodb_conn.close()
+				pchem_data = {'status': False, 'request_post': request_dict, 'data': "Cannot reach OPERA"}
+		
+		elif calc == 'biotrans':
+			biotrans_calc = BiotransCalc()
+			pchem_data = self.backendRequest(calc, biotrans_calc, request_dict)
+
+		elif calc == 'envipath':
+			envipath_calc = EnvipathCalc()
+			pchem_data = self.backendRequest(calc, envipath_calc, request_dict)
+
+		if is_cacheable_result(pchem_data):
+			structure_index.set_result(canonical_key, calc, request_dict, pchem_data, model_version)
+
+		return pchem_data, None
+
 	def runCalc(self, calc, request_dict):
 
 		_response = {}
@@ -194,6 +386,13 @@ class CTS_REST(object):
 			structure = request_dict.get('structure')
 			gen_limit = request_dict.get('generationLimit')
 			trans_libs = request_dict.get('transformationLibraries', [])
+			pchem_props = request_dict.get('pchemProps')
+
+			if pchem_props:
+				try:
+					validate_pchem_props(pchem_props)
+				except ValueError as e:
+					return HttpResponse(json.dumps({'error': "{}".format(e)}), content_type='application/json', status=400)
 
 			# TODO: Add transformationLibraries key:val logic
 			metabolizer_request = {
@@ -212,10 +411,20 @@ class CTS_REST(object):
 			}
 
 			try:
-				response = MetabolizerCalc().data_request_handler(_request)
+				with phase('backend'):
+					response = MetabolizerCalc().data_request_handler(_request)
 			except Exception as e:
 				logging.warning("error making data request: {}".format(e))
 				raise
+
+			if pchem_props:
+				# runs p-chem once per unique product, attached to each node:
+				response = run_product_pchem(self, response, pchem_props, request_dict.get('ph'))
+
+			if request_dict.get('responseFormat') == 'dag':
+				# unique products stored once, streamed out:
+				dag = build_dag(response)
+				return StreamingHttpResponse(stream_dag_response(_response, dag), content_type="application/json")
 				
 			_response.update({'data': response})
 
@@ -224,119 +433,15 @@ class CTS_REST(object):
 
 		else:
 
-			try:
-				_orig_smiles = request_dict.get('chemical')
-				_filtered_smiles = SMILESFilter().filterSMILES(_orig_smiles)
-				request_dict.update({
-					'orig_smiles': _orig_smiles,
-					'chemical': _filtered_smiles,
-				})
-			except AttributeError as ae:
-				# POST type is django QueryDict (most likely)
-				request_dict = dict(request_dict)  # convert QueryDict to dict
-				for key, val in request_dict.items():
-					request_dict.update({key: val[0]})  # vals of QueryDict are lists of 1 item
-
-				request_dict.update({
-					'orig_smiles': _orig_smiles,
-					'chemical': _filtered_smiles,
-				})
-			except Exception as e:
-				logging.warning("exception in cts_rest.py runCalc: {}".format(e))
-				logging.warning("skipping SMILES filter..")
-
-			pchem_data = {}
-			if calc == 'chemaxon':
-				pchem_data = JchemCalc().data_request_handler(request_dict)
-			elif calc == 'epi':
-				_epi_calc = EpiCalc()
-				pchem_data = _epi_calc.data_request_handler(request_dict)
-				if not pchem_data.get('valid'):
-					logging.warning("{} request error: {}".format(calc, pchem_data))
-					_response_obj = {'error': pchem_data.get('data')}
-					_response_obj.update(request_dict)
-					return HttpResponse(json.dumps(_response_obj))
-				# with updated epi, have to pick out desired prop:
-				_methods_list = []
-
-				epi_prop_name = _epi_calc.propMap[request_dict['prop']]['result_key']
-
-				if epi_prop_name == "qsar":
-					_response.update({'data': pchem_data})
-					return HttpResponse(json.dumps(_response), content_type="application/json")
-
-				for data_obj in pchem_data.get('data'):
-					if data_obj['prop'] == epi_prop_name:
-						if data_obj.get('method'):
-							_epi_methods = _epi_calc.propMap.get(request_dict['prop']).get('methods')
-							data_obj['method'] = _epi_methods.get(data_obj['method'])  # use pchem table name for method
-							_methods_list.append(data_obj)
-						else:
-							pchem_data['data'] = data_obj['data'] # only want request prop
-						pchem_data['prop'] = request_dict['prop']  # use cts prop name
-				if len(_methods_list) > 0:
-					# epi water solubility has two data objects..
-					pchem_data['data'] = _methods_list
-
-			elif calc == 'testws':
-				pchem_data = TestWSCalc().data_request_handler(request_dict)
-
-			elif calc == 'sparc':
-				pchem_data = SparcCalc().data_request_handler(request_dict)
-				
-			elif calc == 'measured':
-				pchem_data = MeasuredCalc().data_request_handler(request_dict)
-				if not pchem_data.get('valid'):
-					logging.warning("{} request error: {}".format(calc, pchem_data))
-					_response_obj = {'error': pchem_data.get('data')}
-					_response_obj.update(request_dict)
-					return HttpResponse(json.dumps(_response_obj))
-				# with updated measured, have to pick out desired prop:
-				for data_obj in pchem_data.get('data'):
-					measured_prop_name = MeasuredCalc().propMap[request_dict['prop']]['result_key']
-					if data_obj['prop'] == measured_prop_name:
-						pchem_data['data'] = data_obj['data'] # only want request prop
-						pchem_data['prop'] = request_dict['prop']  # use cts prop name
-
-			elif calc == 'opera':
-
-				opera_calc = OperaCalc()
-
-				try:
-
-					db_results = opera_calc.check_opera_db(request_dict)  # checks db for pchem data
-					if not db_results:
-						logging.info("Running OPERA model.")
-						pchem_data = opera_calc.data_request_handler(request_dict)
-					else:
-						logging.info("Getting OPERA p-chem from database.")
-						pchem_data = {'valid': True, 'request_post': request_dict, 'data': []}
-						db_results = opera_calc.curate_logd(db_results, request_dict, request_dict.get('ph'))
-						pchem_data['data'] = self.wrap_db_results(request_dict, db_results, request_dict.get('props'))
-						pchem_data['data'] = opera_calc.remove_opera_db_duplicates(pchem_data['data'])
-						logging.info("Getting p-chem data from DB.")
-						del db_results['_id']
-						pchem_data = {'status': True, 'request_post': request_dict, 'data': db_results}
-						pchem_data['data'].update(request_dict)
-						pchem_data['data'] = opera_calc.convert_units_for_cts(request_dict['prop'], pchem_data['data'])
-
-				except Exception as e:
-					logging.warning("Error requesting opera data: {}".format(e))
-					db_handler.mongodb_conn.close()
-					pchem_data = {'status': False, 'request_post': request_dict, 'data': "Cannot reach OPERA"}
-			
-			elif calc == 'biotrans':
-				biotrans_calc = BiotransCalc()
-				pchem_data = biotrans_calc.data_request_handler(request_dict)
-
-			elif calc == 'envipath':
-				envipath_calc = EnvipathCalc()
-				pchem_data = envipath_calc.data_request_handler(request_dict)
+			pchem_data, error_obj = self.runPchemCalc(calc, request_dict)
+			if error_obj:
+				return HttpResponse(json.dumps(error_obj))
 
 			_response.update({'data': pchem_data})
 
-
-		return HttpResponse(json.dumps(_response), content_type="application/json")
+		with phase('serialize'):
+			response_json = offload.dumps(_response)  # large results encode in the process pool
+		return HttpResponse(response_json, content_type="application/json")
 
 
 
@@ -635,7 +740,9 @@ class Metabolizer_CTS_REST(CTS_REST):
 		self.inputs = {
 			'structure': '',
 			'generationLimit': 1,
-			'transformationLibraries': ["hydrolysis", "abiotic_reduction", "human_biotransformation"]
+			'transformationLibraries': ["hydrolysis", "abiotic_reduction", "human_biotransformation"],
+			'pchemProps': {},  # optional, e.g., {'chemaxon': ['water_sol'], 'epi': ['kow_no_ph']}
+			'responseFormat': "tree"  # or "dag"
 		}
 		
 
@@ -668,6 +775,11 @@ def getChemicalEditorData(request_post):
 		# 	db_handler.insert_chem_info_data(results['data'])
 		# ########################################################################
 	results = chem_info_obj.get_cheminfo(request_post)  # get recults from calc server
+	try:
+		# maps the user's input and every identifier in the chem info to one key:
+		structure_index.register_cheminfo(results, [request_post.get('chemical')])
+	except Exception as e:
+		logging.warning("error registering chem info in structure index: {}".format(e))
 	json_data = json.dumps(results)
 	return HttpResponse(json_data, content_type='application/json')
 # 	except KeyError as error:
@@ -0,0 +1,162 @@
+"""
+Backend health snapshot for load balancer health/readiness checks.
+
+A background thread probes each calculator backend and Mongo every
+CTS_HEALTH_PROBE_INTERVAL seconds and swaps in a new snapshot, so a
+health check is just a read of the latest snapshot. A snapshot older
+than CTS_HEALTH_STALE_AFTER (default three probe intervals) means the
+prober has stalled, and reports not ready. Backends without a server
+configured are left out of calc and overall status.
+"""
+
+import logging
+import os
+import time
+import threading
+
+import requests
+
+from ..cts_calcs.mongodb_handler import MongoDBHandler
+
+
+
+db_handler = MongoDBHandler()
+
+probe_interval = float(os.environ.get('CTS_HEALTH_PROBE_INTERVAL', 30))
+probe_timeout = float(os.environ.get('CTS_HEALTH_PROBE_TIMEOUT', 5))
+stale_after = float(os.environ.get('CTS_HEALTH_STALE_AFTER', 3 * probe_interval))
+
+# Backend name -> environment variable with its server:
+backend_servers = {
+	'jchem': 'CTS_JCHEM_SERVER',
+	'epi': 'CTS_EPI_SERVER',
+	'test': 'CTS_TEST_SERVER',
+	'sparc': 'CTS_SPARC_SERVER',
+	'opera': 'CTS_OPERA_SERVER',
+	'efs': 'CTS_EFS_SERVER',
+}
+
+# Calc -> backends it needs:
+calc_backends = {
+	'chemaxon': ['jchem'],
+	'epi': ['epi'],
+	'measured': ['epi'],
+	'test': ['test'],
+	'testws': ['test'],
+	'sparc': ['sparc'],
+	'opera': ['opera', 'mongo'],
+	'metabolizer': ['efs'],
+}
+
+_snapshot = None
+_prober = None
+_prober_lock = threading.Lock()
+
+
+
+def probe_http(server):
+	"""
+	Any HTTP response counts as reachable; returns (ok, latency ms, error).
+	"""
+	url = server if server.startswith('http') else "http://{}".format(server)
+	start = time.perf_counter()
+	try:
+		requests.get(url, timeout=probe_timeout)
+		return True, (time.perf_counter() - start) * 1000.0, None
+	except Exception as e:
+		return False, (time.perf_counter() - start) * 1000.0, "{}".format(e)
+
+
+def probe_mongo():
+	start = time.perf_counter()
+	try:
+		if not getattr(db_handler, 'mongodb_conn', None):
+			db_handler.connect_to_db()
+		db_handler.mongodb_conn.admin.command('ping')
+		return True, (time.perf_counter() - start) * 1000.0, None
+	except Exception as e:
+		return False, (time.perf_counter() - start) * 1000.0, "{}".format(e)
+
+
+def probe_backends():
+	"""
+	Probes all backends, returns a snapshot grouped by calc.
+	"""
+	backends = {}
+	for name, env_var in backend_servers.items():
+		server = os.environ.get(env_var)
+		if not server:
+			backends[name] = {'status': "unconfigured"}
+			continue
+		ok, latency, error = probe_http(server)
+		backends[name] = {'status': "ok" if ok else "down", 'latencyMs': round(latency, 1), 'error': error}
+	ok, latency, error = probe_mongo()
+	backends['mongo'] = {'status': "ok" if ok else "down", 'latencyMs': round(latency, 1), 'error': error}
+
+	calcs = {}
+	for calc, names in calc_backends.items():
+		statuses = [backends[name]['status'] for name in names if backends[name]['status'] != "unconfigured"]
+		if not statuses:
+			calc_status = "unconfigured"
+		else:
+			calc_status = "ok" if all(status == "ok" for status in statuses) else "degraded"
+		calcs[calc] = {'status': calc_status, 'backends': names}
+
+	configured_calcs = [calc for calc in calcs.values() if calc['status'] != "unconfigured"]
+	return {
+		'status': "ok" if all(calc['status'] == "ok" for calc in configured_calcs) else "degraded",
+		'timestamp': time.time(),
+		'calcs': calcs,
+		'backends': backends
+	}
+
+
+
+class BackendProber(threading.Thread):
+	"""
+	Refreshes the module snapshot every probe_interval seconds.
+	"""
+	def __init__(self, interval=probe_interval):
+		super(BackendProber, self).__init__(daemon=True)
+		self.interval = interval
+
+	def run(self):
+		global _snapshot
+		while True:
+			try:
+				_snapshot = probe_backends()  # swapped in whole, readers never see a partial snapshot
+			except Exception as e:
+				logging.warning("error probing backends: {}".format(e))
+			time.sleep(self.interval)
+
+
+
+def start_prober():
+	global _prober
+	if _prober is not None:
+		return
+	with _prober_lock:
+		if _prober is None:
+			_prober = BackendProber()
+			_prober.start()
+
+
+def get_health(calc=None):
+	"""
+	Returns (health obj, ready bool) from the latest snapshot. With calc,
+	ready reflects only that calc's backends. Not ready if the snapshot
+	is older than stale_after.
+	"""
+	start_prober()
+	snapshot = _snapshot
+	if snapshot is None:
+		return {'status': "starting"}, False
+	health = dict(snapshot)
+	health['age'] = round(time.time() - snapshot['timestamp'], 1)
+	if health['age'] > stale_after:
+		health['status'] = "stale"
+		return health, False
+	if calc:
+		calc_health = snapshot['calcs'].get(calc)
+		return health, bool(calc_health) and calc_health['status'] == "ok"
+	return health, snapshot['backends']['mongo']['status'] == "ok"
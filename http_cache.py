@@ -0,0 +1,114 @@
+"""
+HTTP caching for GET /{calc}/run requests.
+
+Queries are put in canonical (sorted) order so CDNs and browsers
+share one cache entry per request. Responses get per-calc
+Cache-Control and ETags hashed from the result data (without
+per-request fields like timestamps), so every worker computes the
+same tag for the same result. An If-None-Match matching the stored
+structure index result (shared through Mongo), or the last ETag this
+process served for the query, gets a 304 without a backend call.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+from .structure_index import structure_index, strip_request_fields
+from .result_freshness import get_max_age, get_stale_window, result_freshness
+
+
+
+etag_store_size = 50000
+
+_etags = OrderedDict()  # (calc, canonical query) -> (etag, expires)
+_etags_lock = threading.Lock()
+
+# Per-request fields left out of ETags, along with the request
+# fields strip_request_fields takes out of stored results:
+volatile_keys = ['_requestFields', 'timestamp']
+
+
+
+def canonical_query(query_dict):
+	"""
+	Returns (params, query string) with single values and sorted keys.
+	"""
+	params = {key: query_dict.get(key) for key in query_dict.keys()}
+	return params, urlencode(sorted(params.items()))
+
+
+def result_etag(data, model_version=None):
+	"""
+	Returns ETag for result data, ignoring request fields and
+	volatile_keys, so a stored result and the response built
+	from it get the same tag.
+	"""
+	if isinstance(data, dict):
+		data = {key: val for key, val in strip_request_fields(data).items() if key not in volatile_keys}
+	content = json.dumps([model_version, data], sort_keys=True, default=str).encode('utf-8')
+	return '"{}"'.format(hashlib.sha256(content).hexdigest()[:32])
+
+
+def response_result(content):
+	"""
+	Returns result data from a runCalc response body, or None
+	if it's not a JSON result (e.g., an error object).
+	"""
+	try:
+		response_obj = json.loads(content)
+	except ValueError:
+		return None
+	if isinstance(response_obj, dict):
+		return response_obj.get('data')
+	return None
+
+
+def stored_result_etag(calc, request_params, model_version=None):
+	"""
+	Returns ETag of the structure index result the request would be
+	served, or None if there's no usable stored result.
+	"""
+	canonical_key = structure_index.lookup(request_params.get('chemical'))
+	if not canonical_key:
+		return None
+	entry = structure_index.get_result(canonical_key, calc, request_params)
+	if result_freshness(calc, entry, model_version) == 'expired':
+		return None
+	return result_etag(entry['data'], model_version)
+
+
+def cache_control(calc):
+	return "public, max-age={}, stale-while-revalidate={}".format(int(get_max_age(calc)), int(get_stale_window(calc)))
+
+
+def if_none_match(request, etag):
+	header = request.META.get('HTTP_IF_NONE_MATCH', '')
+	tags = [tag.strip() for tag in header.split(',')]
+	return '*' in tags or etag in tags or 'W/' + etag in tags
+
+
+def get_etag(calc, query):
+	"""
+	Returns the unexpired ETag last served for query, or None.
+	"""
+	with _etags_lock:
+		item = _etags.get((calc, query))
+		if not item:
+			return None
+		etag, expires = item
+		if expires < time.time():
+			del _etags[(calc, query)]
+			return None
+		return etag
+
+
+def set_etag(calc, query, etag):
+	with _etags_lock:
+		_etags[(calc, query)] = (etag, time.time() + get_max_age(calc))
+		_etags.move_to_end((calc, query))
+		while len(_etags) > etag_store_size:
+			_etags.popitem(last=False)
@@ -0,0 +1,72 @@
+"""
+Builds a memory-mapped results pack (see results_pack.py) of
+OPERA and measured p-chem for a list of chemicals.
+
+Usage:
+	python manage.py build_results_pack chemicals.txt --output /path/to/cts_results.pack
+"""
+
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...cts_rest import CTS_REST
+from ...structure_index import structure_index, is_cacheable_result, strip_request_fields
+from ...results_pack import build_results_pack, pack_calcs
+
+
+
+class Command(BaseCommand):
+	help = "Builds a memory-mapped pack of precomputed OPERA/measured p-chem results."
+
+	def add_arguments(self, parser):
+		parser.add_argument('chemicals', help="file with one chemical (smiles, CAS, name) per line")
+		parser.add_argument('--output', required=True, help="results pack path (served with CTS_RESULTS_PACK)")
+		parser.add_argument('--calcs', nargs='+', default=pack_calcs, choices=pack_calcs)
+		parser.add_argument('--props', nargs='+', help="props to compute (default: calc's availableProps)")
+
+	def get_calc_props(self, cts_obj, calc, props):
+		if props:
+			return props
+		meta_info = getattr(cts_obj.getCalcObject(calc), 'meta_info', None) or {}
+		available_props = meta_info.get('metaInfo', meta_info).get('availableProps', [])
+		if not available_props:
+			raise CommandError("no availableProps for {}, use --props".format(calc))
+		return [prop_obj['prop'] for prop_obj in available_props]
+
+	def iter_records(self, cts_obj, chemicals_path, calc_props, aliases):
+		"""
+		Yields (result_key, pchem_data) per chemical/calc/prop,
+		computed through the live runPchemCalc path. Each chemical,
+		as given and as filtered smiles, is added to aliases.
+		"""
+		with open(chemicals_path, 'r') as chemicals_file:
+			for line in chemicals_file:
+				chemical = line.strip()
+				if not chemical:
+					continue
+				for calc, props in calc_props.items():
+					for prop in props:
+						request_dict = {'chemical': chemical, 'calc': calc, 'prop': prop, 'run_type': "rest"}
+						try:
+							pchem_data, error_obj = cts_obj.runPchemCalc(calc, request_dict, use_cache=False)
+						except Exception as e:
+							logging.warning("skipping {} {} {}: {}".format(chemical, calc, prop, e))
+							continue
+						if error_obj or not is_cacheable_result(pchem_data):
+							continue
+						canonical_key = structure_index.resolve(request_dict.get('orig_smiles'), request_dict.get('chemical'))
+						if canonical_key:
+							alias = {'key': canonical_key, 'smiles': request_dict.get('chemical')}
+							aliases[request_dict.get('orig_smiles') or chemical] = alias
+							aliases[request_dict.get('chemical')] = alias
+							yield structure_index.result_key(canonical_key, calc, request_dict), strip_request_fields(pchem_data)
+
+	def handle(self, *args, **options):
+		cts_obj = CTS_REST()
+		calc_props = {calc: self.get_calc_props(cts_obj, calc, options['props']) for calc in options['calcs']}
+		model_versions = {calc: cts_obj.getModelVersion(calc) for calc in options['calcs']}
+		aliases = {}
+		records = self.iter_records(cts_obj, options['chemicals'], calc_props, aliases)
+		count = build_results_pack(records, options['output'], model_versions, aliases)
+		self.stdout.write("Wrote {} results to {}".format(count, options['output']))
@@ -0,0 +1,93 @@
+"""
+Compact DAG representation of metabolizer results.
+
+Stores each unique product once, with parent -> product edges
+labeled by the transformation routes that produced it, and
+streams the result out as JSON chunks.
+
+The DAG is built from the full tree MetabolizerCalc returns, so
+peak memory per request still scales with the tree; the saving is
+in response size (bandwidth and client parsing) only.
+"""
+
+import json
+
+from .metabolizer_pchem import get_node_smiles, walk_metabolizer_nodes, canonical_keys_for
+
+
+
+# Node keys that describe a pathway step rather than the product itself:
+edge_keys = ['routes', 'generation', 'likelihood', 'accumulation', 'production', 'globalAccumulation']
+
+
+
+def build_dag(metabolizer_data):
+	"""
+	Converts a metabolizer tree into {'roots', 'nodes', 'edges'}, where
+	nodes are unique by canonical structure key.
+	"""
+	nodes = {}  # canonical key -> node obj
+	edges = {}  # (source, target, routes) -> edge obj
+	roots = []
+	canonical_keys = canonical_keys_for(get_node_smiles(node) for node in walk_metabolizer_nodes(metabolizer_data))
+
+	stack = [(None, metabolizer_data)]
+	while stack:
+		parent_id, item = stack.pop()
+		if isinstance(item, list):
+			stack.extend((parent_id, child) for child in item)
+			continue
+		if not isinstance(item, dict):
+			continue
+		smiles = get_node_smiles(item)
+		if not smiles:
+			if 'data' in item:
+				stack.append((parent_id, item['data']))
+			continue
+
+		node_data = item.get('data') if isinstance(item.get('data'), dict) else item
+		canonical_key = canonical_keys[smiles]
+
+		if canonical_key not in nodes:
+			node_id = "n{}".format(len(nodes))
+			nodes[canonical_key] = {
+				'id': node_id,
+				'key': canonical_key,
+				'data': {key: val for key, val in node_data.items() if key not in edge_keys and key != 'children'}
+			}
+		node_id = nodes[canonical_key]['id']
+
+		if parent_id is None:
+			if node_id not in roots:
+				roots.append(node_id)
+		else:
+			edge = {'source': parent_id, 'target': node_id}
+			edge.update({key: node_data[key] for key in edge_keys if key in node_data})
+			edge_id = (parent_id, node_id, json.dumps(edge.get('routes'), sort_keys=True, default=str))
+			edges.setdefault(edge_id, edge)
+
+		stack.extend((node_id, child) for child in item.get('children') or [])
+
+	return {
+		'roots': roots,
+		'nodes': list(nodes.values()),
+		'edges': list(edges.values())
+	}
+
+
+def stream_dag_response(response_obj, dag):
+	"""
+	Yields JSON for response_obj with dag as its 'data', one node or
+	edge per chunk, so large pathways aren't built as one string.
+	"""
+	header = dict(response_obj)
+	header.pop('data', None)
+	header_json = json.dumps(header)
+	yield header_json[:-1]
+	yield '{}"data": {{"format": "dag", "roots": {}, "nodes": ['.format(', ' if header else '', json.dumps(dag['roots']))
+	for i, node in enumerate(dag['nodes']):
+		yield (',' if i else '') + json.dumps(node)
+	yield '], "edges": ['
+	for i, edge in enumerate(dag['edges']):
+		yield (',' if i else '') + json.dumps(edge)
+	yield ']}}'
@@ -0,0 +1,135 @@
+"""
+P-chem fan-out over metabolizer transformation products.
+
+Walks a MetabolizerCalc result, dedupes products by canonical
+structure, runs each calculator's p-chem requests concurrently,
+and attaches results back onto every node with that product.
+"""
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from .structure_index import structure_index
+from .request_timing import with_current_timer
+
+
+
+max_workers_per_calc = int(os.environ.get('CTS_PCHEM_FANOUT_WORKERS', 4))
+fanout_calcs = ['chemaxon', 'epi', 'test', 'sparc', 'measured', 'opera']  # runPchemCalc calcs
+
+
+
+def get_node_smiles(node):
+	"""
+	Gets product smiles from a metabolizer tree node.
+	"""
+	if not isinstance(node, dict):
+		return None
+	node_data = node.get('data') if isinstance(node.get('data'), dict) else node
+	smiles = node_data.get('smiles')
+	return smiles if isinstance(smiles, str) and smiles else None
+
+
+def walk_metabolizer_nodes(metabolizer_data):
+	"""
+	Yields every product node in a metabolizer result, whether the
+	tree is nested in 'data' or given as a node/list of nodes.
+	"""
+	stack = [metabolizer_data]
+	while stack:
+		item = stack.pop()
+		if isinstance(item, list):
+			stack.extend(item)
+		elif isinstance(item, dict):
+			if get_node_smiles(item):
+				yield item
+				stack.extend(item.get('children') or [])
+			elif 'data' in item:
+				stack.append(item['data'])
+
+
+def validate_pchem_props(pchem_props):
+	"""
+	Checks pchemProps is {calc: [prop, ...]} with known calcs,
+	raising ValueError if not.
+	"""
+	if not isinstance(pchem_props, dict):
+		raise ValueError("pchemProps must be an object of calc: [prop, ...]")
+	for calc, props in pchem_props.items():
+		if calc not in fanout_calcs:
+			raise ValueError("pchemProps calc must be one of {}".format(fanout_calcs))
+		if not isinstance(props, list) or not all(isinstance(prop, str) and prop for prop in props):
+			raise ValueError("pchemProps values must be lists of props")
+
+
+def canonical_keys_for(smiles_list):
+	"""
+	Looks up each unique smiles once, returns {smiles: canonical_key}.
+	"""
+	return {smiles: structure_index.lookup(smiles) or "smiles:{}".format(smiles) for smiles in set(smiles_list)}
+
+
+def group_products(metabolizer_data):
+	"""
+	Groups metabolizer nodes by canonical structure key.
+	Returns {canonical_key: {'smiles': smiles, 'nodes': [node, ...]}}.
+	"""
+	nodes = list(walk_metabolizer_nodes(metabolizer_data))
+	canonical_keys = canonical_keys_for(get_node_smiles(node) for node in nodes)
+	products = {}
+	for node in nodes:
+		smiles = get_node_smiles(node)
+		product = products.setdefault(canonical_keys[smiles], {'smiles': smiles, 'nodes': []})
+		product['nodes'].append(node)
+	return products
+
+
+def run_calc_requests(cts_rest_obj, calc, requests):
+	"""
+	Runs one calculator's (key, prop, request) list concurrently.
+	"""
+	def _run(item):
+		key, prop, request_dict = item
+		try:
+			pchem_data, error_obj = cts_rest_obj.runPchemCalc(calc, request_dict)
+			return key, prop, error_obj or pchem_data
+		except Exception as e:
+			logging.warning("error running {} {} for metabolite: {}".format(calc, prop, e))
+			return key, prop, {'error': "Error requesting data from {}".format(calc)}
+
+	with ThreadPoolExecutor(max_workers=max_workers_per_calc) as executor:
+		return list(executor.map(with_current_timer(_run), requests))
+
+
+def run_product_pchem(cts_rest_obj, metabolizer_data, pchem_props, ph=None):
+	"""
+	Runs p-chem for each unique product in metabolizer_data and
+	attaches it to each matching node as node['pchem'][calc][prop].
+
+	pchem_props - {calc: [prop, ...]}, checked by validate_pchem_props
+	"""
+	products = group_products(metabolizer_data)
+	logging.info("running p-chem for {} unique metabolizer products".format(len(products)))
+
+	calc_requests = {}
+	for canonical_key, product in products.items():
+		for calc, props in pchem_props.items():
+			for prop in props:
+				request_dict = {'chemical': product['smiles'], 'calc': calc, 'prop': prop, 'run_type': "rest"}
+				if ph is not None:
+					request_dict['ph'] = ph
+				calc_requests.setdefault(calc, []).append((canonical_key, prop, request_dict))
+
+	results = []
+	with ThreadPoolExecutor(max_workers=max(len(calc_requests), 1)) as executor:
+		futures = [executor.submit(with_current_timer(run_calc_requests), cts_rest_obj, calc, requests) for calc, requests in calc_requests.items()]
+		for calc, future in zip(calc_requests.keys(), futures):
+			results.extend((calc, key, prop, data) for key, prop, data in future.result())
+
+	for calc, canonical_key, prop, data in results:
+		for node in products[canonical_key]['nodes']:
+			node_data = node.get('data') if isinstance(node.get('data'), dict) else node
+			node_data.setdefault('pchem', {}).setdefault(calc, {})[prop] = data
+
+	return metabolizer_data
@@ -0,0 +1,165 @@
+"""
+Opt-in micro-batching of single-chemical calculator requests.
+
+Concurrent requests for the same calc and inputs (other than the
+chemical) are gathered for a few milliseconds, sent to the backend
+as one bulk request, and each result is routed back to its caller.
+
+Enabled per calc with CTS_MICROBATCH_CALCS (e.g., "opera"), for calcs
+with a bulk handler: a calculator class's own
+bulk_data_request_handler(list_of_requests) -> list_of_results, or a
+bulk adapter below (OPERA, with CTS_OPERA_BULK_URL set).
+"""
+
+import logging
+import os
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import requests
+
+from .structure_index import structure_index
+
+
+
+batch_window = float(os.environ.get('CTS_MICROBATCH_WINDOW_MS', 5)) / 1000.0
+batch_max_size = int(os.environ.get('CTS_MICROBATCH_MAX_SIZE', 50))
+batch_timeout = float(os.environ.get('CTS_MICROBATCH_TIMEOUT', 300))
+max_groups = int(os.environ.get('CTS_MICROBATCH_MAX_GROUPS', 256))
+enabled_calcs = [calc.strip() for calc in os.environ.get('CTS_MICROBATCH_CALCS', '').split(',') if calc.strip()]
+
+_batchers = OrderedDict()  # group key -> MicroBatcher, least recently used first
+_batchers_lock = threading.Lock()
+
+
+
+class MicroBatcher(object):
+	"""
+	Collects requests for one backend/input group and flushes
+	them to bulk_handler once the window closes or the batch fills.
+	"""
+	def __init__(self, bulk_handler, window=batch_window, max_size=batch_max_size):
+		self.bulk_handler = bulk_handler
+		self.window = window
+		self.max_size = max_size
+		self._pending = []  # list of (request_dict, future)
+		self._lock = threading.Lock()
+		self._timer = None
+
+	def submit(self, request_dict):
+		"""
+		Queues request_dict and blocks until its result is back.
+		"""
+		future = Future()
+		flush_now = False
+		with self._lock:
+			self._pending.append((request_dict, future))
+			if len(self._pending) >= self.max_size:
+				flush_now = True
+			elif self._timer is None:
+				self._timer = threading.Timer(self.window, self.flush)
+				self._timer.daemon = True
+				self._timer.start()
+		if flush_now:
+			self.flush()
+		return future.result(timeout=batch_timeout)
+
+	def flush(self):
+		with self._lock:
+			batch, self._pending = self._pending, []
+			if self._timer is not None:
+				self._timer.cancel()
+				self._timer = None
+		if not batch:
+			return
+		try:
+			results = self.bulk_handler([request_dict for request_dict, future in batch])
+			if len(results) != len(batch):
+				raise ValueError("bulk handler returned {} results for {} requests".format(len(results), len(batch)))
+		except Exception as e:
+			logging.warning("micro-batch request failed: {}".format(e))
+			for request_dict, future in batch:
+				future.set_exception(e)
+			return
+		for (request_dict, future), result in zip(batch, results):
+			future.set_result(result)
+
+
+
+class OperaBulkAdapter(object):
+	"""
+	Bulk OPERA requests to the OPERA service's bulk endpoint
+	(CTS_OPERA_BULK_URL). POSTs the batch's shared inputs with a
+	list of chemicals, e.g.,
+		{'chemicals': ["CCO", "CCC"], 'prop': "water_sol", 'ph': 7.4}
+	and expects {'data': [result, ...]}, one result per chemical in
+	the same order, each as OperaCalc.data_request_handler returns it.
+	"""
+	def __init__(self, url):
+		self.url = url
+
+	def __call__(self, request_dicts):
+		bulk_post = group_inputs(request_dicts[0])
+		bulk_post['chemicals'] = [request_dict.get('chemical') for request_dict in request_dicts]
+		response = requests.post(self.url, json=bulk_post, timeout=batch_timeout)
+		response.raise_for_status()
+		results = response.json().get('data')
+		if not isinstance(results, list) or not all(isinstance(result, dict) for result in results):
+			raise ValueError("OPERA bulk response data must be a list of results")
+		return [dict(result, request_post=request_dict) for request_dict, result in zip(request_dicts, results)]
+
+
+
+def get_bulk_adapters():
+	adapters = {}
+	if os.environ.get('CTS_OPERA_BULK_URL'):
+		adapters['opera'] = OperaBulkAdapter(os.environ['CTS_OPERA_BULK_URL'])
+	return adapters
+
+
+bulk_adapters = get_bulk_adapters()
+
+
+
+def get_bulk_handler(calc, calc_obj):
+	"""
+	Returns calc's bulk handler, or None if it can't be batched.
+	"""
+	if calc not in enabled_calcs:
+		return None
+	bulk_handler = getattr(calc_obj, 'bulk_data_request_handler', None)
+	if callable(bulk_handler):
+		return bulk_handler
+	return bulk_adapters.get(calc)
+
+
+def supports_batching(calc, calc_obj):
+	return get_bulk_handler(calc, calc_obj) is not None
+
+
+def group_inputs(request_dict):
+	"""
+	Inputs a batch shares: all but the requester's own fields (see structure_index.request_keys).
+	"""
+	return {key: val for key, val in request_dict.items() if key not in structure_index.request_keys and val is not None}
+
+
+def batched_request(calc, calc_obj, request_dict):
+	"""
+	Runs calc_obj's request through the micro-batcher for calc and
+	its group_inputs. At most max_groups batchers are kept, least
+	recently used dropped first (a dropped batcher still flushes
+	what it has pending).
+	"""
+	group_key = "{}|{}".format(calc, json.dumps(group_inputs(request_dict), sort_keys=True, default=str))
+	with _batchers_lock:
+		batcher = _batchers.get(group_key)
+		if batcher is None:
+			batcher = MicroBatcher(get_bulk_handler(calc, calc_obj), batch_window, batch_max_size)
+			_batchers[group_key] = batcher
+		_batchers.move_to_end(group_key)
+		while len(_batchers) > max_groups:
+			_batchers.popitem(last=False)
+	return batcher.submit(request_dict)
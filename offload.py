@@ -0,0 +1,111 @@
+"""
+Process-pool offload of CPU-bound result post-processing and encoding.
+
+Large results (by a bounded item count) are handed to a worker process
+pool, so json encoding and prop extraction loops don't hold the GIL
+of a threaded Django worker. The calling thread still holds the GIL
+while pickling a result for the pool, so offloading only pays off for
+results where pickling is well under inline encoding (see
+bench_offload.py); smaller results stay inline.
+"""
+
+import logging
+import os
+import json
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+
+offload_workers = int(os.environ.get('CTS_OFFLOAD_WORKERS', max((os.cpu_count() or 2) // 2, 1)))
+offload_min_items = int(os.environ.get('CTS_OFFLOAD_MIN_ITEMS', 20000))
+offload_start_method = os.environ.get('CTS_OFFLOAD_START_METHOD', 'spawn')  # safe with threaded workers
+offload_enabled = os.environ.get('CTS_OFFLOAD_ENABLED', 'true').lower() == 'true'
+offload_retry_seconds = float(os.environ.get('CTS_OFFLOAD_RETRY', 60))  # after a broken pool
+
+_executor = None
+_executor_lock = threading.Lock()
+_retry_at = 0.0
+
+
+
+def get_executor():
+	global _executor
+	if _executor is None:
+		with _executor_lock:
+			if _executor is None:
+				_executor = ProcessPoolExecutor(
+					max_workers=offload_workers,
+					mp_context=multiprocessing.get_context(offload_start_method)
+				)
+	return _executor
+
+
+def reset_executor(executor):
+	"""
+	Drops a broken pool, so a new one is started after
+	offload_retry_seconds (work runs inline until then).
+	"""
+	global _executor, _retry_at
+	with _executor_lock:
+		if _executor is executor:
+			_executor = None
+			_retry_at = time.time() + offload_retry_seconds
+	executor.shutdown(wait=False)
+
+
+def count_items(obj, limit=offload_min_items):
+	"""
+	Counts containers and values in obj, stopping at limit,
+	so sizing a result costs at most limit steps.
+	"""
+	count = 0
+	stack = [obj]
+	while stack and count < limit:
+		item = stack.pop()
+		count += 1
+		if isinstance(item, dict):
+			stack.extend(item.values())
+		elif isinstance(item, (list, tuple)):
+			stack.extend(item)
+	return count
+
+
+def is_large(obj, size=None):
+	if size is not None:
+		return size >= offload_min_items
+	return count_items(obj) >= offload_min_items
+
+
+def run_cpu_bound(func, *args, size=None):
+	"""
+	Runs func(*args) in the process pool if args are large, else inline.
+	func must be a module-level function importable without django.
+	"""
+	if not offload_enabled or time.time() < _retry_at or not is_large(args, size):
+		return func(*args)
+	executor = get_executor()
+	try:
+		return executor.submit(func, *args).result()
+	except BrokenProcessPool as e:
+		logging.warning("offload pool broken, running inline for {}s: {}".format(offload_retry_seconds, e))
+		reset_executor(executor)
+		return func(*args)
+	except Exception as e:
+		logging.warning("offloaded {} failed, running inline: {}".format(func.__name__, e))
+		return func(*args)
+
+
+def _dumps_bytes(obj):
+	return json.dumps(obj).encode('utf-8')
+
+
+def dumps(obj):
+	"""
+	json.dumps that encodes large objects in the process pool.
+	Returns utf-8 bytes.
+	"""
+	return run_cpu_bound(_dumps_bytes, obj)
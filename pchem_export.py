@@ -0,0 +1,236 @@
+"""
+Streaming columnar export of batch p-chem results.
+
+Rows follow a fixed chemical x calc x prop x method schema built from
+each calculator's availableProps (see *_CTS_REST.meta_info), and are
+written out incrementally as CSV, Arrow IPC, or Parquet, so memory
+stays bounded by the batch size rather than the row count.
+"""
+
+import logging
+import os
+import csv
+import json
+
+
+
+export_columns = ['chemical', 'calc', 'prop', 'method', 'value', 'units', 'error']
+# Arrow/Parquet split value into a float64 column and a string column
+# for JSON or other non-numeric payloads (e.g., pKa objects):
+arrow_columns = ['chemical', 'calc', 'prop', 'method', 'value', 'value_json', 'units', 'error']
+export_formats = {
+	'csv': "text/csv",
+	'arrow': "application/vnd.apache.arrow.stream",
+	'parquet': "application/vnd.apache.parquet",
+}
+export_batch_rows = int(os.environ.get('CTS_EXPORT_BATCH_ROWS', 1000))
+
+
+def export_schema(cts_rest_obj, calcs, props=None):
+	"""
+	Returns list of {'calc', 'prop', 'methods', 'units'} from each
+	calc's availableProps, limited to props if given.
+	"""
+	schema = []
+	for calc in calcs:
+		meta_info = getattr(cts_rest_obj.getCalcObject(calc), 'meta_info', None) or {}
+		for prop_obj in meta_info.get('metaInfo', meta_info).get('availableProps', []):
+			if props and prop_obj['prop'] not in props:
+				continue
+			methods = prop_obj.get('methods') or ([prop_obj['method']] if prop_obj.get('method') else [''])
+			schema.append({
+				'calc': calc,
+				'prop': prop_obj['prop'],
+				'methods': methods,
+				'units': prop_obj.get('units', '')
+			})
+	return schema
+
+
+def export_value(value):
+	if value is None or isinstance(value, (int, float, str)):
+		return value
+	return json.dumps(value)  # e.g., pKa objects
+
+
+def extract_method_values(pchem_data):
+	"""
+	Returns {method: value} from runPchemCalc data, with '' for
+	results that don't come per method.
+	"""
+	data = pchem_data.get('data') if isinstance(pchem_data, dict) else None
+	if isinstance(data, list) and all(isinstance(item, dict) and 'method' in item for item in data):
+		return {item['method']: export_value(item.get('data')) for item in data}
+	method = pchem_data.get('method') if isinstance(pchem_data, dict) else None
+	return {method or '': export_value(data)}
+
+
+def iter_export_rows(cts_rest_obj, chemicals, schema, ph=None):
+	"""
+	Yields one row (list in export_columns order) per
+	chemical x calc x prop x method.
+	"""
+	for chemical in chemicals:
+		for item in schema:
+			calc, prop = item['calc'], item['prop']
+			# chemaxon runs a request per method, other calcs return all methods at once:
+			run_methods = item['methods'] if calc == 'chemaxon' and item['methods'] != [''] else [None]
+			values, error = {}, None
+			for run_method in run_methods:
+				request_dict = {'chemical': chemical, 'calc': calc, 'prop': prop, 'run_type': "rest"}
+				if run_method:
+					request_dict['method'] = run_method
+				if ph is not None:
+					request_dict['ph'] = ph
+				try:
+					pchem_data, error_obj = cts_rest_obj.runPchemCalc(calc, request_dict)
+				except Exception as e:
+					logging.warning("export error for {} {} {}: {}".format(chemical, calc, prop, e))
+					error = "Error requesting data from {}".format(calc)
+					continue
+				if error_obj:
+					error = export_value(error_obj.get('error'))
+					continue
+				method_values = extract_method_values(pchem_data)
+				if run_method:
+					values[run_method] = next(iter(method_values.values()), None)
+				else:
+					values.update(method_values)
+			methods = item['methods']
+			if methods == [''] and values and '' not in values:
+				methods = list(values)  # undeclared methods (e.g., epi water_sol)
+			for method in methods:
+				value = values.get(method, values.get('') if len(methods) == 1 else None)
+				yield [chemical, calc, prop, method, value, item['units'], error]
+
+
+def iter_batches(rows, batch_rows=export_batch_rows):
+	batch = []
+	for row in rows:
+		batch.append(row)
+		if len(batch) >= batch_rows:
+			yield batch
+			batch = []
+	if batch:
+		yield batch
+
+
+
+class _Echo(object):
+	"""
+	File-like object that returns what's written, for csv.writer.
+	"""
+	def write(self, value):
+		return value
+
+
+
+class _ChunkSink(object):
+	"""
+	Writable file-like object whose written bytes are drained per batch.
+	"""
+	def __init__(self):
+		self.chunks = []
+		self.position = 0
+		self.closed = False
+
+	def write(self, data):
+		data = bytes(data)
+		self.chunks.append(data)
+		self.position += len(data)
+		return len(data)
+
+	def tell(self):
+		return self.position
+
+	def flush(self):
+		pass
+
+	def writable(self):
+		return True
+
+	def close(self):
+		self.closed = True
+
+	def drain(self):
+		data, self.chunks = b''.join(self.chunks), []
+		return data
+
+
+
+def stream_csv(rows):
+	writer = csv.writer(_Echo())
+	yield writer.writerow(export_columns)
+	for row in rows:
+		yield writer.writerow(row)
+
+
+def split_value(value):
+	"""
+	Returns (number, text) for a row value: a float for numeric
+	values, else the value as text (None for missing values).
+	"""
+	if value is None:
+		return None, None
+	if isinstance(value, bool):
+		return None, json.dumps(value)
+	try:
+		return float(value), None
+	except (TypeError, ValueError):
+		return None, "{}".format(value)
+
+
+def _text(value):
+	return None if value is None else "{}".format(value)
+
+
+def arrow_batch_columns(batch_rows):
+	"""
+	Returns arrow_columns-ordered column lists for a batch of rows.
+	"""
+	columns = {column: [] for column in arrow_columns}
+	for chemical, calc, prop, method, value, units, error in batch_rows:
+		number, text = split_value(value)
+		columns['value'].append(number)
+		columns['value_json'].append(text)
+		for column, item in zip(['chemical', 'calc', 'prop', 'method', 'units', 'error'], [chemical, calc, prop, method, units, error]):
+			columns[column].append(_text(item))
+	return [columns[column] for column in arrow_columns]
+
+
+def stream_arrow(rows, export_format):
+	"""
+	Yields Arrow IPC stream or Parquet bytes, one record
+	batch/row group per export_batch_rows rows.
+	"""
+	import pyarrow as pa  # optional, only needed for arrow/parquet exports
+	schema = pa.schema([(column, pa.float64() if column == 'value' else pa.string()) for column in arrow_columns])
+	sink = _ChunkSink()
+	if export_format == 'parquet':
+		import pyarrow.parquet as pq
+		writer = pq.ParquetWriter(sink, schema)
+		write_batch = lambda batch: writer.write_table(pa.Table.from_batches([batch]))
+	else:
+		writer = pa.ipc.new_stream(sink, schema)
+		write_batch = writer.write_batch
+	for batch_rows in iter_batches(rows):
+		columns = arrow_batch_columns(batch_rows)
+		write_batch(pa.RecordBatch.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema))
+		yield sink.drain()
+	writer.close()
+	yield sink.drain()
+
+
+def arrow_available():
+	try:
+		import pyarrow
+		import pyarrow.parquet
+		return True
+	except ImportError:
+		return False
+
+
+def stream_export(rows, export_format):
+	if export_format == 'csv':
+		return stream_csv(rows)
+	return stream_arrow(rows, export_format)
@@ -0,0 +1,37 @@
+"""
+Pure p-chem result post-processing, kept free of django and
+calculator imports so it can run in the offload process pool.
+"""
+
+
+
+def select_epi_prop(pchem_data, prop, epi_prop_name, epi_methods):
+	"""
+	Picks requested prop out of EPI's all-props response, using
+	pchem table names for methods. Returns updated pchem_data.
+	"""
+	_methods_list = []
+	for data_obj in pchem_data.get('data'):
+		if data_obj['prop'] == epi_prop_name:
+			if data_obj.get('method'):
+				data_obj['method'] = epi_methods.get(data_obj['method'])  # use pchem table name for method
+				_methods_list.append(data_obj)
+			else:
+				pchem_data['data'] = data_obj['data'] # only want request prop
+			pchem_data['prop'] = prop  # use cts prop name
+	if len(_methods_list) > 0:
+		# epi water solubility has two data objects..
+		pchem_data['data'] = _methods_list
+	return pchem_data
+
+
+def select_measured_prop(pchem_data, prop, measured_prop_name):
+	"""
+	Picks requested prop out of measured's all-props response.
+	Returns updated pchem_data.
+	"""
+	for data_obj in pchem_data.get('data'):
+		if data_obj['prop'] == measured_prop_name:
+			pchem_data['data'] = data_obj['data'] # only want request prop
+			pchem_data['prop'] = prop  # use cts prop name
+	return pchem_data
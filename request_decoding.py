@@ -0,0 +1,236 @@
+"""
+Single-pass decoding and validation of run requests.
+
+Used by every view taking calculator input (/{calc}/run, v2,
+/molecule, export, consensus): the body is parsed once, checked
+against the input schemas in swagger-v2.json, and string fields get
+a cheap, structure-aware sanitize, so bad input is rejected before
+any backend call.
+"""
+
+import os
+import re
+import json
+import math
+import html
+
+
+
+root_path = os.path.abspath(os.path.dirname(__file__))
+swagger_path = os.path.join(root_path, 'static', 'cts_api', 'swagger-v2.json')
+
+# Backslashes that aren't valid JSON escapes, like in swagger-sent smiles (C/C=C\C):
+json_escape_regex = re.compile(r'\\(.)', re.DOTALL)
+json_escapes = set('"\\/bfnrtu')
+chemical_reject_regex = re.compile(r'[<>\x00-\x1f\x7f]')
+html_chars = set('<>&')
+chemical_only_calcs = ['speciation', 'biotrans', 'envipath', 'molecule']  # no prop input
+
+_schemas = None
+
+
+
+class RequestValidationError(ValueError):
+	pass
+
+
+
+def get_schemas():
+	"""
+	Loads input schemas from swagger-v2.json once per process.
+	"""
+	global _schemas
+	if _schemas is None:
+		with open(swagger_path, 'r') as swagger_file:
+			definitions = json.load(swagger_file)['definitions']
+		_schemas = {
+			'pchem': definitions['PchemModelInputs'],
+			'metabolizer': definitions['MetabolizerModelInputs'],
+			'batch': definitions['BatchPchemInputs'],
+		}
+		for schema in _schemas.values():
+			for prop_schema in schema['properties'].values():
+				_compile_patterns(prop_schema)
+	return _schemas
+
+
+def _compile_patterns(prop_schema):
+	if 'pattern' in prop_schema:
+		prop_schema['_regex'] = re.compile(prop_schema['pattern'])
+	for key in ['items', 'additionalProperties']:
+		if isinstance(prop_schema.get(key), dict):
+			_compile_patterns(prop_schema[key])
+
+
+def _fix_escape(match):
+	char = match.group(1)
+	return match.group(0) if char in json_escapes else '\\\\' + char
+
+
+def parse_body(request):
+	"""
+	Parses request body in one pass, doubling stray backslashes
+	(from swagger) before the JSON parse rather than after a failed one.
+	"""
+	body = request.body
+	if not body or request.META.get('CONTENT_TYPE', '').startswith(('application/x-www-form-urlencoded', 'multipart/form-data')):
+		return request.POST.dict()
+	try:
+		body_string = body.decode('utf-8')
+	except UnicodeDecodeError:
+		raise RequestValidationError("request body must be utf-8")
+	if '\\' in body_string:
+		body_string = json_escape_regex.sub(_fix_escape, body_string)
+	try:
+		request_params = json.loads(body_string)
+	except ValueError as e:
+		raise RequestValidationError("request body is not valid json: {}".format(e))
+	if not isinstance(request_params, dict):
+		raise RequestValidationError("request body must be a json object")
+	return request_params
+
+
+def sanitize_value(val):
+	"""
+	Escapes html characters in strings (nested in lists/dicts too),
+	skipping the work for the usual case of none.
+	"""
+	if isinstance(val, str):
+		return html.escape(val, quote=False) if not html_chars.isdisjoint(val) else val
+	if isinstance(val, list):
+		return [sanitize_value(item) for item in val]
+	if isinstance(val, dict):
+		return {key: sanitize_value(item) for key, item in val.items()}
+	return val
+
+
+def _is_number(val):
+	if isinstance(val, bool):
+		return False
+	if isinstance(val, (int, float)):
+		return math.isfinite(val)
+	try:
+		return math.isfinite(float(val))  # form-encoded values are strings
+	except (TypeError, ValueError):
+		return False
+
+
+def _is_integer(val):
+	if isinstance(val, bool):
+		return False
+	if isinstance(val, int):
+		return True
+	return isinstance(val, str) and val.strip().isdigit()
+
+
+def validate_value(key, val, prop_schema):
+	val_type = prop_schema.get('type')
+	if val_type == 'string':
+		if not isinstance(val, str):
+			raise RequestValidationError("{} must be a string".format(key))
+		if len(val) > prop_schema.get('maxLength', len(val)):
+			raise RequestValidationError("{} is too long".format(key))
+		if prop_schema.get('format') == 'chemical' and chemical_reject_regex.search(val):
+			raise RequestValidationError("{} has invalid characters".format(key))
+		if 'enum' in prop_schema and val not in prop_schema['enum']:
+			raise RequestValidationError("{} must be one of {}".format(key, prop_schema['enum']))
+		if '_regex' in prop_schema and not prop_schema['_regex'].match(val):
+			raise RequestValidationError("{} is not valid".format(key))
+	elif val_type in ('number', 'integer'):
+		if not (_is_integer(val) if val_type == 'integer' else _is_number(val)):
+			raise RequestValidationError("{} must be a {}".format(key, val_type))
+		if 'minimum' in prop_schema and float(val) < prop_schema['minimum']:
+			raise RequestValidationError("{} must be at least {}".format(key, prop_schema['minimum']))
+		if 'maximum' in prop_schema and float(val) > prop_schema['maximum']:
+			raise RequestValidationError("{} must be at most {}".format(key, prop_schema['maximum']))
+	elif val_type == 'boolean':
+		if not isinstance(val, bool):
+			raise RequestValidationError("{} must be true or false".format(key))
+	elif val_type == 'array':
+		if not isinstance(val, list):
+			raise RequestValidationError("{} must be a list".format(key))
+		if len(val) < prop_schema.get('minItems', 0):
+			raise RequestValidationError("{} must have at least {} item(s)".format(key, prop_schema['minItems']))
+		for item in val:
+			validate_value(key, item, prop_schema.get('items', {}))
+	elif val_type == 'object':
+		if not isinstance(val, dict):
+			raise RequestValidationError("{} must be an object".format(key))
+		if 'x-keyEnum' in prop_schema and not set(val).issubset(prop_schema['x-keyEnum']):
+			raise RequestValidationError("{} keys must be in {}".format(key, prop_schema['x-keyEnum']))
+		if isinstance(prop_schema.get('additionalProperties'), dict):
+			for item_key, item in val.items():
+				validate_value("{}.{}".format(key, item_key), item, prop_schema['additionalProperties'])
+
+
+def validate_params(request_params, schema, required):
+	"""
+	Validates inputs against a swagger schema, returns sanitized params.
+	"""
+	for key in required:
+		if request_params.get(key) in (None, ''):
+			raise RequestValidationError("missing required input: {}".format(key))
+	properties = schema['properties']
+	for key, val in request_params.items():
+		if key in properties and val is not None:
+			validate_value(key, val, properties[key])
+	return {key: val if key in properties and properties[key].get('type') != 'object' else sanitize_value(val) for key, val in request_params.items()}
+
+
+def validate_run_params(request_params, calc):
+	"""
+	Validates run inputs against calc's swagger schema,
+	returns sanitized params.
+	"""
+	schema = get_schemas()['metabolizer' if calc == 'metabolizer' else 'pchem']
+	required = ['chemical'] if calc in chemical_only_calcs else schema.get('required', [])
+	return validate_params(request_params, schema, required)
+
+
+def validate_inputs_params(request_params):
+	"""
+	Validates a calc inputs query (calc, optional chemical and prop),
+	returns sanitized params.
+	"""
+	return validate_params(request_params, get_schemas()['pchem'], ['calc'])
+
+
+def validate_batch_params(request_params, required=None):
+	"""
+	Validates batch (export, consensus) inputs, returns sanitized params.
+	"""
+	schema = get_schemas()['batch']
+	return validate_params(request_params, schema, required or schema.get('required', []))
+
+
+def decode_run_request(request, calc):
+	"""
+	Parses and validates a /{calc}/run request body.
+	Raises RequestValidationError for bad input.
+	"""
+	return validate_run_params(parse_body(request), calc)
+
+
+def decode_molecule_request(request):
+	"""
+	Parses and validates a /molecule request, sent as a json or form
+	body, or as json in a form's 'message' (e.g., nodejs cts_stress).
+	"""
+	if 'message' in request.POST:
+		try:
+			request_params = json.loads(request.POST['message'])
+		except ValueError as e:
+			raise RequestValidationError("message is not valid json: {}".format(e))
+		if not isinstance(request_params, dict):
+			raise RequestValidationError("message must be a json object")
+	else:
+		request_params = parse_body(request)
+	return validate_run_params(request_params, 'molecule')
+
+
+def decode_batch_request(request, required=None):
+	"""
+	Parses and validates an export/consensus request body.
+	Raises RequestValidationError for bad input.
+	"""
+	return validate_batch_params(parse_body(request), required)
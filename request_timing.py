@@ -0,0 +1,190 @@
+"""
+Per-request phase timing, opt-in profiling, and slow-request logging.
+
+Views decorated with timed_request get a Server-Timing header with
+each phase's duration (decode, smiles_filter, cache, backend,
+postprocess, serialize), as marked with phase() in cts_rest.
+The timer is per thread; work handed to thread pools (metabolizer
+product p-chem, consensus) is wrapped with with_current_timer so its
+phases count too, summed across worker threads, so a phase can
+exceed the request's total.
+
+Requests with an X-CTS-Profile header matching CTS_PROFILE_TOKEN
+are sampled with a stack profiler, saved as collapsed stacks (for
+flame graphs) in CTS_PROFILE_DIR; only the request thread is sampled. Requests slower than
+CTS_SLOW_REQUEST_MS have their phases logged, sampled at
+CTS_SLOW_REQUEST_SAMPLE.
+"""
+
+import logging
+import os
+import sys
+import time
+import hmac
+import random
+import uuid
+import threading
+import functools
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+
+
+
+profile_token = os.environ.get('CTS_PROFILE_TOKEN', '')
+profile_dir = os.environ.get('CTS_PROFILE_DIR', '/tmp/cts_profiles')
+profile_interval = float(os.environ.get('CTS_PROFILE_INTERVAL_MS', 5)) / 1000.0
+slow_request_ms = float(os.environ.get('CTS_SLOW_REQUEST_MS', 5000))
+slow_request_sample = float(os.environ.get('CTS_SLOW_REQUEST_SAMPLE', 1.0))
+
+_local = threading.local()
+
+
+
+class RequestTimer(object):
+	"""
+	Accumulates durations (ms) of named phases within a request.
+	"""
+	def __init__(self):
+		self.start = time.perf_counter()
+		self.phases = OrderedDict()
+		self._lock = threading.Lock()  # phases can be added from worker threads
+
+	def add(self, name, duration_ms):
+		with self._lock:
+			self.phases[name] = self.phases.get(name, 0.0) + duration_ms
+
+	def total_ms(self):
+		return (time.perf_counter() - self.start) * 1000.0
+
+	def server_timing(self, total_ms):
+		items = ["{};dur={:.1f}".format(name, duration) for name, duration in self.phases.items()]
+		items.append("total;dur={:.1f}".format(total_ms))
+		return ", ".join(items)
+
+
+
+class SamplingProfiler(object):
+	"""
+	Samples one thread's stack at a fixed interval from a
+	background thread, counting collapsed stacks.
+	"""
+	def __init__(self, thread_id, interval=profile_interval):
+		self.thread_id = thread_id
+		self.interval = interval
+		self.stacks = Counter()
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+
+	def _run(self):
+		while not self._stop.wait(self.interval):
+			frame = sys._current_frames().get(self.thread_id)
+			stack = []
+			while frame is not None:
+				code = frame.f_code
+				stack.append("{}:{}:{}".format(os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+				frame = frame.f_back
+			if stack:
+				self.stacks[";".join(reversed(stack))] += 1
+
+	def start(self):
+		self._thread.start()
+
+	def stop(self):
+		self._stop.set()
+		self._thread.join()
+
+	def save(self, name):
+		"""
+		Writes collapsed stacks to profile_dir, returns file path.
+		"""
+		os.makedirs(profile_dir, exist_ok=True)
+		path = os.path.join(profile_dir, "{}.collapsed".format(name))
+		with open(path, 'w') as profile_file:
+			for stack, count in self.stacks.most_common():
+				profile_file.write("{} {}\n".format(stack, count))
+		return path
+
+
+
+def current_timer():
+	return getattr(_local, 'timer', None)
+
+
+def with_current_timer(func):
+	"""
+	Wraps func to time its phases under the calling thread's
+	request timer, for running in a worker thread.
+	"""
+	timer = current_timer()
+	if timer is None:
+		return func
+
+	@functools.wraps(func)
+	def _wrapped(*args, **kwargs):
+		previous = current_timer()
+		_local.timer = timer
+		try:
+			return func(*args, **kwargs)
+		finally:
+			_local.timer = previous
+	return _wrapped
+
+
+@contextmanager
+def phase(name):
+	"""
+	Times a block as phase name of the current request (no-op outside one).
+	"""
+	timer = current_timer()
+	if timer is None:
+		yield
+		return
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		timer.add(name, (time.perf_counter() - start) * 1000.0)
+
+
+def profiling_requested(request):
+	header = request.META.get('HTTP_X_CTS_PROFILE')
+	return bool(profile_token and header and hmac.compare_digest(header.encode('utf-8'), profile_token.encode('utf-8')))
+
+
+def timed_request(view_func):
+	"""
+	View decorator adding Server-Timing, opt-in profiling,
+	and slow-request logging.
+	"""
+	@functools.wraps(view_func)
+	def _wrapped(request, *args, **kwargs):
+		timer = RequestTimer()
+		_local.timer = timer
+		profiler = None
+		if profiling_requested(request):
+			profiler = SamplingProfiler(threading.get_ident())
+			profiler.start()
+		try:
+			response = view_func(request, *args, **kwargs)
+		finally:
+			_local.timer = None
+			if profiler:
+				profiler.stop()
+
+		total_ms = timer.total_ms()
+		server_timing = timer.server_timing(total_ms)
+		response['Server-Timing'] = server_timing
+
+		if profiler:
+			try:
+				profile_id = "{}-{}".format(time.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8])
+				profiler.save(profile_id)
+				response['X-CTS-Profile-Id'] = profile_id
+			except Exception as e:
+				logging.warning("error saving request profile: {}".format(e))
+
+		if total_ms >= slow_request_ms and random.random() < slow_request_sample:
+			logging.warning("slow request {} {} ({:.0f} ms): {}".format(request.method, request.path, total_ms, server_timing))
+
+		return response
+	return _wrapped
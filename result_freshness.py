@@ -0,0 +1,90 @@
+"""
+Stale-while-revalidate policy for stored calculator results.
+
+A result younger than a calc's max age is fresh. Past that, it's
+still served for the calc's stale window while a background thread
+refreshes it. A result from a different model version is expired.
+
+Per-calc windows (seconds) can be set with environment variables,
+e.g., CTS_RESULT_MAX_AGE_OPERA and CTS_RESULT_STALE_WINDOW_OPERA.
+"""
+
+import logging
+import os
+import time
+import threading
+
+
+
+default_max_age = 7 * 24 * 3600
+default_stale_window = 30 * 24 * 3600
+
+calc_max_age = {
+	'chemaxon': default_max_age,
+	'epi': default_max_age,
+	'testws': default_max_age,
+	'sparc': default_max_age,
+	'measured': 30 * 24 * 3600,
+	'opera': default_max_age,
+	'biotrans': 24 * 3600,
+	'envipath': 24 * 3600,
+}
+
+calc_stale_window = {
+	'biotrans': 7 * 24 * 3600,
+	'envipath': 7 * 24 * 3600,
+}
+
+_refreshing = set()  # result keys with a refresh in flight
+_refreshing_lock = threading.Lock()
+
+
+
+def get_max_age(calc):
+	env_val = os.environ.get("CTS_RESULT_MAX_AGE_{}".format(calc.upper()))
+	return float(env_val) if env_val else calc_max_age.get(calc, default_max_age)
+
+
+def get_stale_window(calc):
+	env_val = os.environ.get("CTS_RESULT_STALE_WINDOW_{}".format(calc.upper()))
+	return float(env_val) if env_val else calc_stale_window.get(calc, default_stale_window)
+
+
+def result_freshness(calc, result_entry, model_version):
+	"""
+	Returns 'fresh', 'stale', or 'expired' for a stored result entry.
+	"""
+	if not result_entry:
+		return 'expired'
+	if model_version and result_entry.get('modelVersion') != model_version:
+		return 'expired'  # backend upgrade forces recompute
+	age = time.time() - (result_entry.get('timestamp') or 0)
+	max_age = get_max_age(calc)
+	if age <= max_age:
+		return 'fresh'
+	if age <= max_age + get_stale_window(calc):
+		return 'stale'
+	return 'expired'
+
+
+def refresh_in_background(refresh_key, refresh_func, *args, **kwargs):
+	"""
+	Runs refresh_func in a daemon thread, at most once at a
+	time per refresh_key.
+	"""
+	with _refreshing_lock:
+		if refresh_key in _refreshing:
+			return False
+		_refreshing.add(refresh_key)
+
+	def _refresh():
+		try:
+			refresh_func(*args, **kwargs)
+		except Exception as e:
+			logging.warning("error refreshing stale result {}: {}".format(refresh_key, e))
+		finally:
+			with _refreshing_lock:
+				_refreshing.discard(refresh_key)
+
+	threading.Thread(target=_refresh, daemon=True).start()
+	return True
@@ -0,0 +1,195 @@
+"""
+Memory-mapped pack of precomputed p-chem results (OPERA, measured).
+
+Results are stored post-processed (curated, de-duplicated, and
+unit-converted) as returned by CTS_REST.runPchemCalc, without
+request fields (see structure_index.strip_request_fields), keyed
+by the structure index result key. The file is mapped read-only, so its
+pages are shared by every worker process on the host.
+
+File layout:
+	magic (8 bytes) | count (uint64) | meta length (uint32)
+	meta: utf-8 JSON, {'modelVersions': {calc: modelVersion}}
+	index: count x (key digest (16 bytes), offset (uint64), length (uint32)), sorted by digest
+	data: utf-8 JSON blobs
+
+Besides results, the index holds "alias|{identifier}" entries mapping
+each chemical the pack was built from (as given, and as filtered
+SMILES) to {'key': canonical key, 'smiles': filtered SMILES}, so
+packed results are found without resolving the structure remotely.
+
+Entries from a calc whose modelVersion differs from the live one
+are skipped, and a rebuilt pack swapped in at the same path is
+picked up by running workers on their next lookup.
+"""
+
+import logging
+import os
+import json
+import mmap
+import struct
+import hashlib
+import tempfile
+import threading
+
+from .structure_index import structure_index
+
+
+
+pack_magic = b'CTSPACK3'
+header_struct = struct.Struct('<8sQI')
+entry_struct = struct.Struct('<16sQI')
+pack_calcs = ['opera', 'measured']
+alias_prefix = "alias|"
+
+_pack = None
+_pack_failed_stat = None  # (path, file stat) that failed to open
+_pack_lock = threading.Lock()
+
+
+
+def key_digest(result_key):
+	return hashlib.blake2b(result_key.encode('utf-8'), digest_size=16).digest()
+
+
+
+class ResultsPack(object):
+	"""
+	Read-only, memory-mapped results pack.
+	"""
+	def __init__(self, path, file_stat=None):
+		self.path = path
+		self.file_stat = file_stat
+		with open(path, 'rb') as pack_file:
+			self._mmap = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, self.count, meta_length = header_struct.unpack_from(self._mmap, 0)
+		if magic != pack_magic:
+			raise ValueError("{} is not a CTS results pack".format(path))
+		meta = json.loads(self._mmap[header_struct.size:header_struct.size + meta_length])
+		self.model_versions = meta.get('modelVersions') or {}
+		self._index_start = header_struct.size + meta_length
+
+	def _digest_at(self, i):
+		start = self._index_start + i * entry_struct.size
+		return self._mmap[start:start + 16]
+
+	def get(self, result_key):
+		"""
+		Binary searches the index for result_key, returns decoded data or None.
+		"""
+		digest = key_digest(result_key)
+		lo, hi = 0, self.count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self._digest_at(mid) < digest:
+				lo = mid + 1
+			else:
+				hi = mid
+		if lo >= self.count or self._digest_at(lo) != digest:
+			return None
+		_, offset, length = entry_struct.unpack_from(self._mmap, self._index_start + lo * entry_struct.size)
+		return json.loads(self._mmap[offset:offset + length])
+
+	def get_alias(self, identifier):
+		"""
+		Returns {'key', 'smiles'} packed for identifier, or None.
+		"""
+		if not isinstance(identifier, str) or not identifier.strip():
+			return None
+		return self.get(alias_prefix + identifier.strip())
+
+	def lookup(self, canonical_key, calc, request_dict, model_version=None):
+		"""
+		Returns packed data for the request, or None if it's not in
+		the pack or was built with a different calc model version.
+		"""
+		if not canonical_key:
+			return None
+		if model_version and self.model_versions.get(calc) != model_version:
+			return None
+		return self.get(structure_index.result_key(canonical_key, calc, request_dict))
+
+
+
+def build_results_pack(records, path, model_versions=None, aliases=None):
+	"""
+	Writes (result_key, data) records to a results pack at path,
+	tagged with model_versions ({calc: modelVersion}), plus aliases
+	({identifier: {'key', 'smiles'}}, read after records, so it can be
+	filled in as they're generated). Data blobs are spooled to a temp
+	file, so only the index is held in memory. Later records replace
+	earlier ones with the same key. Returns the number of results.
+	"""
+	index = {}
+	meta = json.dumps({'modelVersions': model_versions or {}}).encode('utf-8')
+	out_dir = os.path.dirname(os.path.abspath(path))
+	with tempfile.TemporaryFile(dir=out_dir) as data_file:
+		data_size = 0
+		for result_key, data in records:
+			blob = json.dumps(data, separators=(',', ':')).encode('utf-8')
+			index[key_digest(result_key)] = (data_size, len(blob))
+			data_file.write(blob)
+			data_size += len(blob)
+		result_count = len(index)
+		for identifier, alias in (aliases or {}).items():
+			blob = json.dumps(alias, separators=(',', ':')).encode('utf-8')
+			index[key_digest(alias_prefix + identifier.strip())] = (data_size, len(blob))
+			data_file.write(blob)
+			data_size += len(blob)
+
+		data_start = header_struct.size + len(meta) + len(index) * entry_struct.size
+		tmp_fd, tmp_path = tempfile.mkstemp(dir=out_dir)
+		try:
+			with os.fdopen(tmp_fd, 'wb') as pack_file:
+				pack_file.write(header_struct.pack(pack_magic, len(index), len(meta)))
+				pack_file.write(meta)
+				for digest in sorted(index):
+					offset, length = index[digest]
+					pack_file.write(entry_struct.pack(digest, data_start + offset, length))
+				data_file.seek(0)
+				while True:
+					chunk = data_file.read(1 << 20)
+					if not chunk:
+						break
+					pack_file.write(chunk)
+			os.replace(tmp_path, path)  # new inode, reopened by get_results_pack
+		except Exception:
+			os.remove(tmp_path)
+			raise
+	return result_count
+
+
+def _stat_key(path):
+	try:
+		file_stat = os.stat(path)
+	except OSError:
+		return None
+	return (file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+
+
+def get_results_pack():
+	"""
+	Returns the pack at CTS_RESULTS_PACK, or None. The pack is
+	reopened when the file at that path is replaced (new inode or
+	mtime), and retried if it was missing or unreadable before.
+	"""
+	global _pack, _pack_failed_stat
+	path = os.environ.get('CTS_RESULTS_PACK')
+	if not path:
+		return None
+	file_stat = _stat_key(path)
+	if file_stat is None:
+		return None
+	if _pack is not None and _pack.path == path and _pack.file_stat == file_stat:
+		return _pack
+	if _pack_failed_stat == (path, file_stat):
+		return None
+	with _pack_lock:
+		if _pack is None or _pack.path != path or _pack.file_stat != file_stat:
+			try:
+				_pack = ResultsPack(path, file_stat)
+			except Exception as e:
+				logging.warning("cannot open results pack {}: {}".format(path, e))
+				_pack_failed_stat = (path, file_stat)
+				return None
+	return _pack
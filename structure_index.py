@@ -0,0 +1,341 @@
+"""
+Structure-identity index for CTS REST results.
+
+Maps every identifier seen by the API (SMILES, CAS, name, etc.)
+to a single canonical key (InChIKey or DTXSID when known), so
+equivalent inputs share calculator results.
+"""
+
+import logging
+import os
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from ..cts_calcs.chemical_information import ChemInfo
+from ..cts_calcs.mongodb_handler import MongoDBHandler
+
+
+
+db_handler = MongoDBHandler()
+chem_info_obj = ChemInfo()
+
+mongo_retry_seconds = float(os.environ.get('CTS_STRUCTURE_INDEX_MONGO_RETRY', 60))
+fallback_ttl = float(os.environ.get('CTS_STRUCTURE_INDEX_FALLBACK_TTL', 600))
+
+# Request fields naming the requester's input, rather than changing
+# the result; left out of result keys and stored results:
+request_fields = ['chemical', 'orig_smiles', 'run_type']
+
+
+
+class StructureIndex(object):
+	"""
+	Identifier -> canonical key index, with a results store keyed
+	on canonical key. Both are persisted in Mongo and fronted by
+	an in-memory LRU hot set.
+	"""
+	def __init__(self, hot_size=10000):
+		self.hot_size = hot_size
+		self.alias_collection_name = "structure_aliases"
+		self.result_collection_name = "structure_results"
+		self.canonical_keys = ['inchiKey', 'inchikey', 'dsstoxSubstanceId', 'dtxsid']  # order of preference
+		self.identifier_keys = ['chemical', 'orig_smiles', 'smiles', 'casrn', 'cas', 'preferredName', 'iupac', 'dtxsid', 'dsstoxSubstanceId']
+		self.request_keys = request_fields + ['calc']  # every other request key is part of the result key
+		self._aliases = OrderedDict()
+		self._fallbacks = OrderedDict()  # identifier -> (fallback key, expires), never persisted
+		self._results = OrderedDict()
+		self._lock = threading.Lock()
+		self._mongo_retry_at = 0.0
+
+	def _get_collection(self, name):
+		"""
+		Returns Mongo collection, or None if the DB can't be reached.
+		After a failure, mongo is skipped for mongo_retry_seconds so
+		requests don't each block on server selection while it's down.
+		"""
+		if time.time() < self._mongo_retry_at:
+			return None
+		try:
+			if getattr(db_handler, 'db_conn', None) is None:  # pymongo Database has no truth value
+				db_handler.connect_to_db()
+			return db_handler.db_conn[name]
+		except Exception as e:
+			self._mongo_failed(e)
+			return None
+
+	def _mongo_failed(self, error):
+		logging.warning("structure index cannot reach mongo, retrying in {}s: {}".format(mongo_retry_seconds, error))
+		self._mongo_retry_at = time.time() + mongo_retry_seconds
+
+	def _hot_get(self, store, key):
+		with self._lock:
+			if key not in store:
+				return None
+			store.move_to_end(key)
+			return store[key]
+
+	def _hot_set(self, store, key, val):
+		with self._lock:
+			store[key] = val
+			store.move_to_end(key)
+			while len(store) > self.hot_size:
+				store.popitem(last=False)
+
+	def normalize_identifier(self, identifier):
+		if not isinstance(identifier, str):
+			return None
+		return identifier.strip()
+
+	def cheminfo_data(self, cheminfo):
+		"""
+		Unwraps chem info from a get_cheminfo() response, which
+		nests it in 'data' (and sometimes 'data'/'chemInfo' lists).
+		"""
+		while isinstance(cheminfo, dict) and not any(cheminfo.get(key) for key in self.canonical_keys + ['smiles']):
+			cheminfo = cheminfo.get('data') or cheminfo.get('chemInfo')
+		if isinstance(cheminfo, list):
+			return self.cheminfo_data(cheminfo[0]) if cheminfo else None
+		return cheminfo if isinstance(cheminfo, dict) else None
+
+	def canonical_key_from_cheminfo(self, cheminfo_data):
+		"""
+		Picks canonical key out of ChemInfo.get_cheminfo() data.
+		"""
+		if not isinstance(cheminfo_data, dict):
+			return None
+		for key in self.canonical_keys:
+			if cheminfo_data.get(key):
+				return "{}:{}".format(key.lower(), cheminfo_data[key])
+		if cheminfo_data.get('smiles'):
+			return "smiles:{}".format(cheminfo_data['smiles'])
+		return None
+
+	def register(self, identifier, canonical_key):
+		"""
+		Records identifier -> canonical key in hot set and mongo.
+		"""
+		identifier = self.normalize_identifier(identifier)
+		if not identifier or not canonical_key:
+			return
+		if self._hot_get(self._aliases, identifier) == canonical_key:
+			return
+		self._hot_set(self._aliases, identifier, canonical_key)
+		collection = self._get_collection(self.alias_collection_name)
+		if collection is None:
+			return
+		try:
+			collection.update_one(
+				{'_id': identifier},
+				{'$set': {'key': canonical_key}},
+				upsert=True
+			)
+		except Exception as e:
+			self._mongo_failed(e)
+
+	def register_cheminfo(self, cheminfo_data, identifiers=None):
+		"""
+		Registers all identifiers within get_cheminfo() data (or a
+		response wrapping it), plus any extra identifiers (e.g., the
+		raw user input). Returns canonical key.
+		"""
+		cheminfo_data = self.cheminfo_data(cheminfo_data)
+		canonical_key = self.canonical_key_from_cheminfo(cheminfo_data)
+		if not canonical_key:
+			return None
+		all_identifiers = list(identifiers or [])
+		for key in self.identifier_keys:
+			all_identifiers.append(cheminfo_data.get(key))
+		for identifier in all_identifiers:
+			self.register(identifier, canonical_key)
+			self._fallbacks.pop(self.normalize_identifier(identifier), None)
+		return canonical_key
+
+	def lookup(self, identifier):
+		"""
+		Returns canonical key for identifier if it's been seen, else None.
+		"""
+		identifier = self.normalize_identifier(identifier)
+		if not identifier:
+			return None
+		canonical_key = self._hot_get(self._aliases, identifier)
+		if canonical_key:
+			return canonical_key
+		collection = self._get_collection(self.alias_collection_name)
+		if collection is None:
+			return None
+		try:
+			doc = collection.find_one({'_id': identifier})
+		except Exception as e:
+			self._mongo_failed(e)
+			return None
+		if not doc:
+			return None
+		self._hot_set(self._aliases, identifier, doc['key'])
+		return doc['key']
+
+	def get_fallback(self, identifier):
+		identifier = self.normalize_identifier(identifier)
+		with self._lock:
+			item = self._fallbacks.get(identifier)
+			if not item:
+				return None
+			if item[1] < time.time():
+				del self._fallbacks[identifier]
+				return None
+			return item[0]
+
+	def set_fallback(self, identifier, fallback_key):
+		"""
+		Records a smiles fallback key in the hot set only, so the
+		identifier is resolved through ChemInfo again after fallback_ttl.
+		"""
+		identifier = self.normalize_identifier(identifier)
+		if not identifier:
+			return
+		with self._lock:
+			self._fallbacks[identifier] = (fallback_key, time.time() + fallback_ttl)
+			self._fallbacks.move_to_end(identifier)
+			while len(self._fallbacks) > self.hot_size:
+				self._fallbacks.popitem(last=False)
+
+	def resolve(self, orig_chemical, filtered_smiles=None):
+		"""
+		Gets canonical key for a user's chemical, resolving it
+		through ChemInfo the first time it's seen.
+		"""
+		for identifier in [orig_chemical, filtered_smiles]:
+			canonical_key = self.lookup(identifier)
+			if canonical_key:
+				self.register(orig_chemical, canonical_key)
+				self.register(filtered_smiles, canonical_key)
+				return canonical_key
+		for identifier in [orig_chemical, filtered_smiles]:
+			canonical_key = self.get_fallback(identifier)
+			if canonical_key:
+				return canonical_key
+		try:
+			cheminfo = chem_info_obj.get_cheminfo({'chemical': filtered_smiles or orig_chemical}, only_dsstox=True)
+			canonical_key = self.register_cheminfo(cheminfo, [orig_chemical, filtered_smiles])
+		except Exception as e:
+			logging.warning("structure index cannot resolve {}: {}".format(orig_chemical, e))
+			canonical_key = None
+		if not canonical_key and filtered_smiles:
+			# Falls back to filtered smiles so equivalent smiles still share results:
+			canonical_key = "smiles:{}".format(filtered_smiles)
+			self.set_fallback(orig_chemical, canonical_key)
+			self.set_fallback(filtered_smiles, canonical_key)
+		return canonical_key
+
+	def result_key(self, canonical_key, calc, request_dict):
+		"""
+		Builds results store key from canonical key, calc, and all
+		request inputs besides request_keys (prop, ph, method, gen_limit, etc.).
+		"""
+		result_inputs = {key: val for key, val in request_dict.items() if key not in self.request_keys and val is not None}
+		return "{}|{}|{}".format(canonical_key, calc, json.dumps(result_inputs, sort_keys=True, default=str))
+
+	def get_result(self, canonical_key, calc, request_dict):
+		"""
+		Returns stored result entry, {'data', 'timestamp', 'modelVersion'}, or None.
+		"""
+		if not canonical_key:
+			return None
+		key = self.result_key(canonical_key, calc, request_dict)
+		entry = self._hot_get(self._results, key)
+		if entry is not None:
+			return entry
+		collection = self._get_collection(self.result_collection_name)
+		if collection is None:
+			return None
+		try:
+			doc = collection.find_one({'_id': key})
+		except Exception as e:
+			self._mongo_failed(e)
+			return None
+		if not doc:
+			return None
+		entry = {
+			'data': doc['data'],
+			'timestamp': doc.get('timestamp'),
+			'modelVersion': doc.get('modelVersion')
+		}
+		self._hot_set(self._results, key, entry)
+		return entry
+
+	def set_result(self, canonical_key, calc, request_dict, data, model_version=None):
+		"""
+		Stores result data without its request fields (see strip_request_fields).
+		"""
+		if not canonical_key:
+			return
+		key = self.result_key(canonical_key, calc, request_dict)
+		entry = {'data': strip_request_fields(data), 'timestamp': time.time(), 'modelVersion': model_version}
+		self._hot_set(self._results, key, entry)
+		collection = self._get_collection(self.result_collection_name)
+		if collection is None:
+			return
+		try:
+			collection.update_one({'_id': key}, {'$set': entry}, upsert=True)
+		except Exception as e:
+			self._mongo_failed(e)
+
+
+
+def strip_request_fields(pchem_data):
+	"""
+	Returns a copy of pchem_data to store for every requester: without
+	request_post or request_fields, at the top level or within a 'data'
+	dict (e.g., OPERA DB results). Removed fields are listed in
+	'_requestFields', for restore_request_fields to fill back in.
+	"""
+	stored = dict(pchem_data)
+	removed = list(stored.get('_requestFields') or [])
+	for key in ['request_post'] + request_fields:
+		if key in stored:
+			del stored[key]
+			removed.append(key)
+	if isinstance(stored.get('data'), dict):
+		stored['data'] = dict(stored['data'])
+		for key in request_fields:
+			if key in stored['data']:
+				del stored['data'][key]
+				removed.append("data." + key)
+	stored['_requestFields'] = removed
+	return stored
+
+
+def restore_request_fields(stored, request_dict):
+	"""
+	Returns stored result data (see strip_request_fields) with the
+	current request's fields put back where the calc had them.
+	"""
+	pchem_data = dict(stored)
+	removed = pchem_data.pop('_requestFields', None) or []
+	if isinstance(pchem_data.get('data'), dict):
+		pchem_data['data'] = dict(pchem_data['data'])
+	for path in removed:
+		if path == 'request_post':
+			pchem_data['request_post'] = request_dict
+		elif path.startswith("data.") and isinstance(pchem_data.get('data'), dict):
+			if path[5:] in request_dict:
+				pchem_data['data'][path[5:]] = request_dict[path[5:]]
+		elif path in request_dict:
+			pchem_data[path] = request_dict[path]
+	return pchem_data
+
+
+def is_cacheable_result(pchem_data):
+	"""
+	Only stores results that came back valid from a calculator.
+	"""
+	if not isinstance(pchem_data, dict) or pchem_data.get('error'):
+		return False
+	if pchem_data.get('valid') is False or pchem_data.get('status') is False:
+		return False
+	return pchem_data.get('data') is not None
+
+
+
+structure_index = StructureIndex()
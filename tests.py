@@ -1,3 +1,819 @@
-from django.test import TestCase
+from django.test import TestCase, Client, RequestFactory
+from django.http import HttpResponse
+from unittest import mock, skipUnless
+import copy
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures.process import BrokenProcessPool
 
-# Create your tests here.
+from . import structure_index as structure_index_module
+from .structure_index import StructureIndex
+from .metabolizer_pchem import run_product_pchem, validate_pchem_props
+from .metabolizer_graph import build_dag, stream_dag_response
+from .result_freshness import result_freshness, refresh_in_background, get_max_age
+from . import results_pack as results_pack_module
+from .results_pack import ResultsPack, build_results_pack, get_results_pack
+from . import http_cache
+from . import cts_rest as cts_rest_module
+from .cts_rest import CTS_REST
+from . import pchem_export
+from . import offload
+from . import micro_batch
+from . import request_timing
+from . import health
+
+
+
+class FakeCollection(object):
+	"""
+	In-memory stand-in for a Mongo collection.
+	"""
+	def __init__(self):
+		self.docs = {}
+
+	def find_one(self, query):
+		return self.docs.get(query['_id'])
+
+	def update_one(self, query, update, upsert=False):
+		self.docs.setdefault(query['_id'], {'_id': query['_id']}).update(update['$set'])
+
+
+
+class FakeDatabase(object):
+	"""
+	Like pymongo's Database, has no truth value.
+	"""
+	def __init__(self):
+		self.collections = {}
+
+	def __bool__(self):
+		raise NotImplementedError("Database objects do not implement truth value testing")
+
+	def __getitem__(self, name):
+		return self.collections.setdefault(name, FakeCollection())
+
+
+
+class StructureIndexTests(TestCase):
+
+	def setUp(self):
+		self.db = FakeDatabase()
+		self.db_handler = mock.Mock(db_conn=self.db)
+		patcher = mock.patch.object(structure_index_module, 'db_handler', self.db_handler)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.index = StructureIndex()
+
+	def test_persists_aliases_after_connecting(self):
+		self.index.register("CCO", "inchikey:LFQSCWFLJHTTHZ-UHFFFAOYSA-N")
+		self.index.register("64-17-5", "inchikey:LFQSCWFLJHTTHZ-UHFFFAOYSA-N")
+		self.assertEqual(len(self.db['structure_aliases'].docs), 2)
+
+	def test_skips_mongo_after_failure(self):
+		self.db_handler.db_conn = None
+		self.db_handler.connect_to_db.side_effect = RuntimeError("no mongo")
+		self.assertIsNone(self.index.lookup("CCO"))
+		self.assertIsNone(self.index.lookup("CCC"))
+		self.assertEqual(self.db_handler.connect_to_db.call_count, 1)
+
+	def test_resolve_registers_cheminfo_identifiers(self):
+		cheminfo = {'status': True, 'data': {'inchiKey': "LFQSCWFLJHTTHZ-UHFFFAOYSA-N", 'smiles': "CCO", 'casrn': "64-17-5"}}
+		with mock.patch.object(structure_index_module.chem_info_obj, 'get_cheminfo', return_value=cheminfo):
+			canonical_key = self.index.resolve("ethanol", "CCO")
+		self.assertEqual(canonical_key, "inchikey:LFQSCWFLJHTTHZ-UHFFFAOYSA-N")
+		self.assertEqual(self.index.lookup("64-17-5"), canonical_key)
+		self.assertEqual(self.index.lookup("ethanol"), canonical_key)
+
+	def test_fallback_keys_are_not_persisted(self):
+		with mock.patch.object(structure_index_module.chem_info_obj, 'get_cheminfo', side_effect=RuntimeError("down")):
+			canonical_key = self.index.resolve("OCC", "CCO")
+		self.assertEqual(canonical_key, "smiles:CCO")
+		self.assertIsNone(self.index.lookup("OCC"))
+		self.assertEqual(self.db['structure_aliases'].docs, {})
+
+	def test_fallback_expires(self):
+		cheminfo = {'data': {'inchiKey': "LFQSCWFLJHTTHZ-UHFFFAOYSA-N"}}
+		with mock.patch.object(structure_index_module, 'fallback_ttl', -1):
+			with mock.patch.object(structure_index_module.chem_info_obj, 'get_cheminfo', side_effect=RuntimeError("down")):
+				self.index.resolve("OCC", "CCO")
+		with mock.patch.object(structure_index_module.chem_info_obj, 'get_cheminfo', return_value=cheminfo):
+			canonical_key = self.index.resolve("OCC", "CCO")
+		self.assertEqual(canonical_key, "inchikey:LFQSCWFLJHTTHZ-UHFFFAOYSA-N")
+
+	def test_result_key_covers_result_inputs(self):
+		key = self.index.result_key("inchikey:KEY", 'biotrans', {'chemical': "CCO", 'gen_limit': 1})
+		self.assertNotEqual(key, self.index.result_key("inchikey:KEY", 'biotrans', {'chemical': "CCO", 'gen_limit': 2}))
+		self.assertEqual(key, self.index.result_key("inchikey:KEY", 'biotrans', {'chemical': "OCC", 'orig_smiles': "ethanol", 'gen_limit': 1, 'run_type': "rest"}))
+
+	def test_stored_results_take_current_request_fields(self):
+		first_request = {'chemical': "CCO", 'orig_smiles': "ethanol", 'prop': "water_sol", 'run_type': "rest"}
+		pchem_data = {'status': True, 'request_post': first_request, 'data': dict(first_request, water_sol=1.5)}
+		self.index.set_result("inchikey:KEY", 'opera', first_request, pchem_data)
+		stored = self.index.get_result("inchikey:KEY", 'opera', first_request)['data']
+		self.assertNotIn("ethanol", json.dumps(stored))
+
+		second_request = {'chemical': "OCC", 'orig_smiles': "64-17-5", 'prop': "water_sol", 'run_type': "rest"}
+		restored = structure_index_module.restore_request_fields(stored, second_request)
+		self.assertEqual(restored['request_post'], second_request)
+		self.assertEqual(restored['data'], dict(second_request, water_sol=1.5))
+		self.assertEqual(http_cache.result_etag(stored), http_cache.result_etag(restored))
+
+
+
+metabolizer_tree = {
+	'id': 1,
+	'data': {'smiles': "CCC(=O)OCC", 'generation': 0},
+	'children': [
+		{'id': 2, 'data': {'smiles': "CCC(=O)O", 'routes': "hydrolysis", 'generation': 1}, 'children': []},
+		{'id': 3, 'data': {'smiles': "CCO", 'routes': "hydrolysis", 'generation': 1}, 'children': [
+			{'id': 4, 'data': {'smiles': "CC=O", 'routes': "oxidation", 'generation': 2}, 'children': []}
+		]},
+		{'id': 5, 'data': {'smiles': "CCO", 'routes': "reduction", 'generation': 1}, 'children': []}
+	]
+}
+
+
+
+class FakeCTSRest(object):
+	"""
+	Returns a fixed value per calc/prop in place of runPchemCalc.
+	"""
+	def __init__(self, values=None):
+		self.values = values or {}
+		self.requests = []
+
+	def runPchemCalc(self, calc, request_dict):
+		self.requests.append((calc, dict(request_dict)))
+		return {'data': self.values.get((request_dict['chemical'], calc, request_dict['prop']), 1.0)}, None
+
+
+
+class MetabolizerPchemTests(TestCase):
+
+	def setUp(self):
+		patcher = mock.patch.object(structure_index_module.structure_index, 'lookup', return_value=None)
+		self.lookup = patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_runs_once_per_unique_product(self):
+		cts_obj = FakeCTSRest()
+		data = run_product_pchem(cts_obj, copy.deepcopy(metabolizer_tree), {'chemaxon': ["water_sol"]})
+		self.assertEqual(len(cts_obj.requests), 4)
+		self.assertEqual(self.lookup.call_count, 4)
+		for child in data['children']:
+			self.assertEqual(child['data']['pchem']['chemaxon']['water_sol'], {'data': 1.0})
+
+	def test_rejects_bad_pchem_props(self):
+		for pchem_props in [{'chemaxon': "water_sol"}, {'nope': ["water_sol"]}, {'testws': ["water_sol"]}, {'epi': [1]}, ["chemaxon"]]:
+			with self.assertRaises(ValueError):
+				validate_pchem_props(pchem_props)
+		validate_pchem_props({'chemaxon': ["water_sol"], 'epi': ["kow_no_ph", "koc"], 'test': ["water_sol"]})
+
+
+
+class MetabolizerGraphTests(TestCase):
+
+	def setUp(self):
+		patcher = mock.patch.object(structure_index_module.structure_index, 'lookup', return_value=None)
+		self.lookup = patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_stores_each_product_once(self):
+		dag = build_dag(copy.deepcopy(metabolizer_tree))
+		self.assertEqual(self.lookup.call_count, 4)
+		self.assertEqual(dag['roots'], ["n0"])
+		self.assertEqual(sorted(node['key'] for node in dag['nodes']), sorted("smiles:{}".format(smiles) for smiles in ["CCC(=O)OCC", "CCC(=O)O", "CCO", "CC=O"]))
+		ethanol_id = next(node['id'] for node in dag['nodes'] if node['key'] == "smiles:CCO")
+		ethanol_routes = sorted(edge['routes'] for edge in dag['edges'] if edge['target'] == ethanol_id)
+		self.assertEqual(ethanol_routes, ["hydrolysis", "reduction"])
+		self.assertEqual(len(dag['edges']), 4)
+		for node in dag['nodes']:
+			self.assertNotIn('routes', node['data'])
+
+	def test_streams_valid_json(self):
+		dag = build_dag(copy.deepcopy(metabolizer_tree))
+		response_obj = {'metaInfo': {'model': "metabolizer"}, 'data': None}
+		streamed = json.loads("".join(stream_dag_response(response_obj, dag)))
+		self.assertEqual(streamed['metaInfo'], {'model': "metabolizer"})
+		self.assertEqual(streamed['data']['format'], "dag")
+		self.assertEqual(streamed['data']['nodes'], dag['nodes'])
+		self.assertEqual(streamed['data']['edges'], dag['edges'])
+
+	def test_streams_empty_dag(self):
+		streamed = json.loads("".join(stream_dag_response({}, {'roots': [], 'nodes': [], 'edges': []})))
+		self.assertEqual(streamed, {'data': {'format': "dag", 'roots': [], 'nodes': [], 'edges': []}})
+
+
+
+class ResultFreshnessTests(TestCase):
+
+	def entry(self, age, model_version="1.0"):
+		return {'data': {}, 'timestamp': time.time() - age, 'modelVersion': model_version}
+
+	def test_freshness_windows(self):
+		with mock.patch.dict('os.environ', {'CTS_RESULT_MAX_AGE_CHEMAXON': "100", 'CTS_RESULT_STALE_WINDOW_CHEMAXON': "50"}):
+			self.assertEqual(result_freshness('chemaxon', self.entry(10), "1.0"), 'fresh')
+			self.assertEqual(result_freshness('chemaxon', self.entry(120), "1.0"), 'stale')
+			self.assertEqual(result_freshness('chemaxon', self.entry(200), "1.0"), 'expired')
+
+	def test_model_version_change_expires(self):
+		self.assertEqual(result_freshness('epi', self.entry(0, "4.10"), "4.11"), 'expired')
+		self.assertEqual(result_freshness('epi', self.entry(0, "4.10"), None), 'fresh')
+
+	def test_missing_entry_expired(self):
+		self.assertEqual(result_freshness('epi', None, "4.11"), 'expired')
+
+	def test_one_refresh_per_key(self):
+		release = threading.Event()
+		calls = []
+		def _refresh(value):
+			calls.append(value)
+			release.wait(5)
+		self.assertTrue(refresh_in_background('key', _refresh, 1))
+		self.assertFalse(refresh_in_background('key', _refresh, 2))
+		release.set()
+		for i in range(100):
+			if refresh_in_background('key', lambda: None):
+				break
+			time.sleep(0.01)
+		else:
+			self.fail("refresh key never released")
+		self.assertEqual(calls, [1])
+
+
+
+class RunPchemCalcTests(TestCase):
+	"""
+	runPchemCalc against a structure index over an in-memory
+	database, with a mocked chemaxon calc.
+	"""
+	def setUp(self):
+		patcher = mock.patch.object(structure_index_module, 'db_handler', mock.Mock(db_conn=FakeDatabase()))
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.index = StructureIndex()
+		self.index.register("CCO", "inchikey:LFQSCWFLJHTTHZ-UHFFFAOYSA-N")
+		self.calc_obj = mock.Mock()
+		self.calc_obj.data_request_handler.return_value = {'valid': True, 'data': 2.0}
+		patchers = [
+			mock.patch.object(cts_rest_module, 'structure_index', self.index),
+			mock.patch.object(cts_rest_module, 'JchemCalc', return_value=self.calc_obj),
+			mock.patch.object(CTS_REST, 'getModelVersion', return_value="v2"),
+		]
+		for patcher in patchers:
+			patcher.start()
+			self.addCleanup(patcher.stop)
+		self.request_dict = {'chemical': "CCO", 'prop': "water_sol"}
+
+	def store(self, model_version, age):
+		self.index.set_result("inchikey:LFQSCWFLJHTTHZ-UHFFFAOYSA-N", 'chemaxon', self.request_dict, {'valid': True, 'data': 1.0}, model_version)
+		key = self.index.result_key("inchikey:LFQSCWFLJHTTHZ-UHFFFAOYSA-N", 'chemaxon', self.request_dict)
+		self.index._results[key]['timestamp'] -= age
+
+	def test_serves_stale_and_refreshes(self):
+		self.store("v2", age=get_max_age('chemaxon') + 60)
+		with mock.patch.object(cts_rest_module, 'refresh_in_background') as refresh:
+			pchem_data, error_obj = CTS_REST().runPchemCalc('chemaxon', dict(self.request_dict))
+		self.assertEqual(pchem_data['data'], 1.0)
+		self.calc_obj.data_request_handler.assert_not_called()
+		refresh.assert_called_once()
+		self.assertEqual(refresh.call_args[0][2], 'chemaxon')
+		self.assertEqual(refresh.call_args[1], {'use_cache': False})
+
+	def test_model_version_change_calls_backend(self):
+		self.store("v1", age=0)
+		with mock.patch.object(cts_rest_module, 'refresh_in_background') as refresh:
+			pchem_data, error_obj = CTS_REST().runPchemCalc('chemaxon', dict(self.request_dict))
+		self.assertEqual(pchem_data['data'], 2.0)
+		self.calc_obj.data_request_handler.assert_called_once()
+		refresh.assert_not_called()
+		entry = self.index.get_result("inchikey:LFQSCWFLJHTTHZ-UHFFFAOYSA-N", 'chemaxon', self.request_dict)
+		self.assertEqual(entry['modelVersion'], "v2")
+
+
+
+class ResultsPackTests(TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.TemporaryDirectory()
+		self.addCleanup(self.tmp_dir.cleanup)
+		self.path = os.path.join(self.tmp_dir.name, "cts_results.pack")
+		self.request_dict = {'chemical': "CCO", 'prop': "water_sol"}
+		patcher = mock.patch.object(results_pack_module, '_pack', None)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def build(self, records, model_versions=None, aliases=None):
+		return build_results_pack(iter(records), self.path, model_versions or {'opera': "2.9"}, aliases)
+
+	def record(self, chemical_key, value, calc='opera'):
+		result_key = structure_index_module.structure_index.result_key(chemical_key, calc, self.request_dict)
+		return result_key, {'valid': True, 'data': value}
+
+	def test_round_trip(self):
+		records = [self.record("inchikey:KEY{}".format(i), i) for i in range(500)]
+		self.assertEqual(self.build(records + [self.record("inchikey:KEY7", "latest")]), 500)
+		pack = ResultsPack(self.path)
+		self.assertEqual(pack.count, 500)
+		self.assertEqual(pack.lookup("inchikey:KEY3", 'opera', self.request_dict, "2.9"), {'valid': True, 'data': 3})
+		self.assertEqual(pack.lookup("inchikey:KEY7", 'opera', self.request_dict, "2.9")['data'], "latest")
+		self.assertIsNone(pack.lookup("inchikey:MISSING", 'opera', self.request_dict, "2.9"))
+		self.assertIsNone(pack.lookup("inchikey:KEY3", 'measured', self.request_dict))
+
+	def test_skips_other_model_versions(self):
+		self.build([self.record("inchikey:KEY", 1)])
+		pack = ResultsPack(self.path)
+		self.assertIsNone(pack.lookup("inchikey:KEY", 'opera', self.request_dict, "3.0"))
+		self.assertEqual(pack.lookup("inchikey:KEY", 'opera', self.request_dict)['data'], 1)
+
+	def test_rejects_other_files(self):
+		with open(self.path, 'wb') as pack_file:
+			pack_file.write(b'not a pack' * 10)
+		with self.assertRaises(ValueError):
+			ResultsPack(self.path)
+
+	def test_reopens_replaced_pack(self):
+		with mock.patch.dict('os.environ', {'CTS_RESULTS_PACK': self.path}):
+			self.assertIsNone(get_results_pack())  # missing at startup
+			self.build([self.record("inchikey:KEY", 1)])
+			self.assertEqual(get_results_pack().lookup("inchikey:KEY", 'opera', self.request_dict)['data'], 1)
+			self.build([self.record("inchikey:KEY", 2)])
+			self.assertEqual(get_results_pack().lookup("inchikey:KEY", 'opera', self.request_dict)['data'], 2)
+
+	def test_serves_aliases_before_resolving(self):
+		alias = {'key': "inchikey:LFQSCWFLJHTTHZ-UHFFFAOYSA-N", 'smiles': "CCO"}
+		self.assertEqual(self.build([self.record(alias['key'], 1.5)], aliases={"ethanol": alias, "CCO": alias}), 1)
+		self.assertEqual(ResultsPack(self.path).get_alias(" ethanol "), alias)
+		with mock.patch.dict('os.environ', {'CTS_RESULTS_PACK': self.path}), \
+				mock.patch.object(CTS_REST, 'getModelVersion', return_value="2.9"), \
+				mock.patch.object(cts_rest_module.structure_index, 'resolve') as resolve, \
+				mock.patch.object(cts_rest_module, 'SMILESFilter') as smiles_filter:
+			smiles_filter.return_value.filterSMILES.return_value = "CCO"
+			request_dict = {'chemical': "ethanol", 'prop': "water_sol"}
+			pchem_data, error_obj = CTS_REST().runPchemCalc('opera', request_dict)
+			self.assertEqual(pchem_data['data'], 1.5)
+			self.assertEqual((request_dict['orig_smiles'], request_dict['chemical']), ("ethanol", "CCO"))
+			smiles_filter.assert_not_called()
+
+			pchem_data, error_obj = CTS_REST().runPchemCalc('opera', {'chemical': "OCC", 'prop': "water_sol"})
+			self.assertEqual(pchem_data['data'], 1.5)
+			smiles_filter.return_value.filterSMILES.assert_called_once_with("OCC")
+			resolve.assert_not_called()
+
+
+
+class PchemViewTestCase(TestCase):
+	"""
+	Client tests with CTS_REST.runPchemCalc replaced by run_pchem_calc,
+	which records each request; subclasses override it for their values.
+	"""
+	def setUp(self):
+		self.client = Client()
+		self.requests = []
+		patcher = mock.patch.object(CTS_REST, 'runPchemCalc', side_effect=self.run_pchem_calc)
+		self.run_pchem = patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def run_pchem_calc(self, calc, request_dict, use_cache=True):
+		self.requests.append(dict(request_dict))
+		return {'valid': True, 'data': 1.0}, None
+
+	def post(self, url, body, content_type='application/json'):
+		return self.client.post(url, body if isinstance(body, str) else json.dumps(body), content_type=content_type)
+
+
+
+class HttpCacheTests(PchemViewTestCase):
+
+	def setUp(self):
+		super(HttpCacheTests, self).setUp()
+		self.pchem_data = {'valid': True, 'calc': "chemaxon", 'prop': "water_sol", 'data': 1234.5}
+		patcher = mock.patch.object(http_cache, '_etags', OrderedDict())
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def run_pchem_calc(self, calc, request_dict, use_cache=True):
+		pchem_data = dict(self.pchem_data)
+		pchem_data['request_post'] = dict(request_dict)
+		return pchem_data, None
+
+	def test_redirects_to_canonical_query(self):
+		response = self.client.get("/chemaxon/run?prop=water_sol&chemical=CCC")
+		self.assertEqual(response.status_code, 301)
+		self.assertTrue(response['Location'].endswith("/chemaxon/run?chemical=CCC&prop=water_sol"))
+
+	def test_etag_ignores_timestamps(self):
+		url = "/chemaxon/run?chemical=CCC&prop=water_sol"
+		first = self.client.get(url)
+		http_cache._etags.clear()  # as if served by another worker
+		second = self.client.get(url)
+		self.assertEqual(first.status_code, 200)
+		self.assertIn('public', first['Cache-Control'])
+		self.assertNotEqual(first.content, second.content)  # metaInfo timestamps differ
+		self.assertEqual(first['ETag'], second['ETag'])
+
+	def test_not_modified_from_process_etag(self):
+		url = "/chemaxon/run?chemical=CCC&prop=water_sol"
+		etag = self.client.get(url)['ETag']
+		response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+		self.assertEqual(response.status_code, 304)
+		self.assertEqual(self.run_pchem.call_count, 1)
+
+	def test_not_modified_from_stored_result(self):
+		canonical_key = "inchikey:HTTPCACHETESTKEY"
+		request_dict = {'chemical': "CCCO", 'prop': "water_sol"}
+		model_version = CTS_REST().getModelVersion('chemaxon')
+		with mock.patch.object(structure_index_module, 'db_handler', mock.Mock(db_conn=FakeDatabase())):
+			structure_index_module.structure_index.register("CCCO", canonical_key)
+			structure_index_module.structure_index.set_result(canonical_key, 'chemaxon', request_dict, self.pchem_data, model_version)
+			etag = http_cache.result_etag(self.pchem_data, model_version)
+			response = self.client.get("/chemaxon/run?chemical=CCCO&prop=water_sol", HTTP_IF_NONE_MATCH=etag)
+		self.assertEqual(response.status_code, 304)
+		self.assertEqual(response['ETag'], etag)
+		self.run_pchem.assert_not_called()
+
+	def test_errors_not_cached(self):
+		self.pchem_data = {'error': "bad"}
+		with mock.patch.object(CTS_REST, 'runPchemCalc', return_value=({}, {'error': "bad"})):
+			response = self.client.get("/chemaxon/run?chemical=CCC&prop=water_sol")
+		self.assertEqual(response['Cache-Control'], "no-store")
+		self.assertFalse(response.has_header('ETag'))
+
+	def test_invalid_results_not_cached(self):
+		for pchem_data in [{'valid': False, 'data': "bad smiles"}, {'status': False, 'data': "Cannot reach OPERA"}]:
+			self.pchem_data = pchem_data
+			response = self.client.get("/chemaxon/run?chemical=CCC&prop=water_sol")
+			self.assertEqual(response['Cache-Control'], "no-store", pchem_data)
+			self.assertFalse(response.has_header('ETag'))
+
+	def test_stored_result_checked_only_for_conditional_requests(self):
+		url = "/chemaxon/run?chemical=CCC&prop=water_sol"
+		with mock.patch.object(http_cache, 'stored_result_etag', return_value=None) as stored_result_etag:
+			self.client.get(url)
+			stored_result_etag.assert_not_called()
+			http_cache._etags.clear()
+			self.client.get(url, HTTP_IF_NONE_MATCH='"other"')
+			stored_result_etag.assert_called_once()
+
+
+
+class PchemExportTests(PchemViewTestCase):
+
+	values = {'CCC': 39.0, 'CCO': {'pKa': [15.5], 'pKb': []}}
+
+	def run_pchem_calc(self, calc, request_dict, use_cache=True):
+		return {'valid': True, 'data': self.values[request_dict['chemical']]}, None
+
+	def test_streams_csv(self):
+		response = self.post("/export", {'chemicals': ["CCC", "CCO"], 'calcs': ["epi"], 'props': ["water_sol"]})
+		lines = b"".join(response.streaming_content).decode('utf-8').splitlines()
+		self.assertEqual(lines[0], ",".join(pchem_export.export_columns))
+		self.assertEqual(lines[1], "CCC,epi,water_sol,,39.0,mg/L,")
+		self.assertEqual(len(lines), 3)
+
+	def test_rejects_bad_inputs(self):
+		for body in [
+			{'chemicals': "CCC"},
+			{'chemicals': []},
+			{'chemicals': [123]},
+			{'chemicals': ["<b>CCC</b>"]},
+			{'chemicals': ["CCC"], 'calcs': "epi"},
+			{'chemicals': ["CCC"], 'calcs': ["nope"]},
+			{'chemicals': ["CCC"], 'props': "water_sol"},
+			{'chemicals': ["CCC"], 'format': "xlsx"},
+		]:
+			response = self.post("/export", body)
+			self.assertEqual(response.status_code, 400, body)
+
+	@skipUnless(pchem_export.arrow_available(), "pyarrow not installed")
+	def test_arrow_value_columns(self):
+		import pyarrow as pa
+		response = self.post("/export", {'chemicals': ["CCC", "CCO"], 'calcs': ["epi"], 'props': ["water_sol"], 'format': "arrow"})
+		table = pa.ipc.open_stream(b"".join(response.streaming_content)).read_all()
+		self.assertEqual(table.schema.field('value').type, pa.float64())
+		self.assertEqual(table.column('value').to_pylist(), [39.0, None])
+		self.assertEqual(json.loads(table.column('value_json').to_pylist()[1]), {'pKa': [15.5], 'pKb': []})
+
+
+
+class ConsensusTests(PchemViewTestCase):
+
+	values = {
+		('CCC', 'chemaxon'): 2.0, ('CCC', 'epi'): 3.0,
+		('CCO', 'chemaxon'): -0.3, ('CCO', 'epi'): "N/A",
+	}
+
+	def run_pchem_calc(self, calc, request_dict, use_cache=True):
+		return {'valid': True, 'data': self.values.get((request_dict['chemical'], calc))}, None
+
+	def test_stats_and_outliers(self):
+		import numpy as np
+		from .consensus import consensus_stats
+		values = np.array([[1.0, 2.0, 3.0, 100.0], [np.nan, np.nan, np.nan, np.nan], [5.0, np.nan, 5.0, 5.0]])
+		stats = consensus_stats(values)
+		self.assertEqual(stats['n'].tolist(), [4, 0, 3])
+		self.assertEqual(stats['median'][0], 2.5)
+		self.assertEqual(stats['outliers'][0].tolist(), [False, False, False, True])
+		self.assertTrue(np.isnan(stats['mean'][1]))
+		self.assertFalse(stats['outliers'][2].any())  # zero spread, no outliers
+		self.assertEqual(stats['std'][2], 0.0)
+
+	def test_repeated_chemicals(self):
+		from .consensus import run_consensus
+		results = run_consensus(CTS_REST(), ["CCC", "CCO", "CCC"], ["kow_no_ph"], ["chemaxon", "epi"])
+		chemical_results = results['kow_no_ph']['chemicals']
+		self.assertEqual([result['chemical'] for result in chemical_results], ["CCC", "CCO", "CCC"])
+		self.assertEqual(chemical_results[0]['n'], chemical_results[2]['n'])
+		self.assertEqual(chemical_results[0]['mean'], chemical_results[2]['mean'])
+		self.assertEqual(chemical_results[1]['n'], 3)  # chemaxon KLOP/PHYS/VG, epi not numeric
+		self.assertIsNone(chemical_results[1]['values']['epi'])
+
+	def test_rejects_bad_inputs(self):
+		for body in [
+			{'chemicals': ["CCC"]},
+			{'chemicals': ["CCC"], 'props': "kow_no_ph"},
+			{'chemicals': ["CCC"], 'props': []},
+			{'chemicals': ["CCC"], 'props': ["kow_no_ph"], 'calcs': "epi"},
+			{'chemicals': ["CCC"], 'props': ["kow_no_ph"], 'aggregatesOnly': "yes"},
+		]:
+			response = self.post("/consensus", body)
+			self.assertEqual(response.status_code, 400, body)
+
+
+
+class RequestDecodingTests(PchemViewTestCase):
+
+	def test_runs_valid_request(self):
+		response = self.post("/chemaxon/run", {'chemical': "CCC", 'prop': "kow_wph", 'ph': 7.4, 'method': "KLOP"})
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(self.requests[0]['ph'], 7.4)
+
+	def test_keeps_swagger_backslashes(self):
+		response = self.post("/epi/run", '{"chemical": "C/C=C\\C(=O)O", "prop": "water_sol"}')
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(self.requests[0]['chemical'], "C/C=C\\C(=O)O")
+
+	def test_form_body(self):
+		response = self.client.post("/chemaxon/run", {'chemical': "CCC", 'prop': "water_sol", 'ph': "7.0"})
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(self.requests[0]['chemical'], "CCC")
+
+	def test_rejects_bad_run_requests(self):
+		for body in [
+			"not json",
+			"[1, 2]",
+			{'chemical': "CCC"},
+			{'chemical': "CCC", 'prop': "water sol"},
+			{'chemical': "<script>CCC", 'prop': "water_sol"},
+			{'chemical': ["CCC"], 'prop': "water_sol"},
+			{'chemical': "CCC", 'prop': "water_sol", 'ph': 20},
+			{'chemical': "CCC", 'prop': "water_sol", 'ph': "NaN"},
+			{'chemical': "CCC", 'prop': "water_sol", 'calc': "nope"},
+		]:
+			response = self.post("/chemaxon/run", body)
+			self.assertEqual(response.status_code, 400, body)
+		self.assertEqual(self.requests, [])
+
+	def test_rejects_bad_metabolizer_requests(self):
+		for body in [
+			{'structure': "CCC", 'generationLimit': 0},
+			{'structure': "CCC", 'responseFormat': "graph"},
+			{'structure': "CCC", 'pchemProps': {'chemaxon': "water_sol"}},
+			{'structure': "CCC", 'pchemProps': {'nope': ["water_sol"]}},
+			{'structure': "CCC", 'pchemProps': {'testws': ["water_sol"]}},
+			{'structure': "CCC", 'pchemProps': {'epi': ["water sol"]}},
+			{'structure': "CCC", 'transformationLibraries': "hydrolysis"},
+		]:
+			response = self.post("/metabolizer/run", body)
+			self.assertEqual(response.status_code, 400, body)
+
+	def test_proxy_get_reads_query(self):
+		from . import views
+		factory = RequestFactory()
+		with mock.patch.object(CTS_REST, 'getCalcInputs', return_value=HttpResponse("{}")) as get_inputs:
+			response = views.cts_rest_proxy(factory.get("/v2", {'calc': "chemaxon", 'chemical': "CCC", 'prop': "water_sol"}))
+			self.assertEqual(response.status_code, 200)
+			get_inputs.assert_called_once_with("CCC", "chemaxon", "water_sol")
+			self.assertEqual(views.cts_rest_proxy(factory.get("/v2", {'calc': "chemaxon"})).status_code, 200)
+			for query in [{}, {'calc': "nope"}, {'calc': "chemaxon", 'chemical': "<b>CCC</b>"}]:
+				self.assertEqual(views.cts_rest_proxy(factory.get("/v2", query)).status_code, 400, query)
+		response = views.cts_rest_proxy(factory.post("/v2", json.dumps({'calc': "chemaxon", 'chemical': "CCC", 'prop': "water_sol"}), content_type='application/json'))
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(self.requests[0]['chemical'], "CCC")
+
+	def test_molecule_requests(self):
+		with mock.patch('cts_app.cts_api.cts_rest.getChemicalEditorData', return_value=HttpResponse("{}")) as get_data:
+			self.assertEqual(self.post("/molecule", {'chemical': "<img src=x>"}).status_code, 400)
+			self.assertEqual(self.client.post("/molecule", {'message': "not json"}).status_code, 400)
+			self.assertEqual(self.client.post("/molecule", {'message': json.dumps({'chemical': "aspirin"})}).status_code, 200)
+			self.assertEqual(self.post("/molecule", {'chemical': "aspirin", 'get_structure_data': True}).status_code, 200)
+		self.assertEqual(get_data.call_args_list[0][0][0], {'chemical': "aspirin"})
+		self.assertEqual(get_data.call_args_list[1][0][0]['get_structure_data'], True)
+
+
+
+class OffloadTests(TestCase):
+
+	def test_small_results_run_inline(self):
+		with mock.patch.object(offload, 'get_executor') as get_executor:
+			self.assertEqual(offload.dumps({'data': [1, 2]}), b'{"data": [1, 2]}')
+		get_executor.assert_not_called()
+
+	def test_resets_broken_pool(self):
+		broken_executor = mock.Mock()
+		broken_executor.submit.side_effect = BrokenProcessPool("worker died")
+		with mock.patch.object(offload, '_executor', broken_executor), mock.patch.object(offload, '_retry_at', 0.0):
+			self.assertEqual(offload.run_cpu_bound(sorted, [3, 1, 2], size=10 ** 9), [1, 2, 3])
+			self.assertIsNone(offload._executor)
+			with mock.patch.object(offload, 'get_executor') as get_executor:
+				self.assertEqual(offload.run_cpu_bound(sorted, [2, 1], size=10 ** 9), [1, 2])
+			get_executor.assert_not_called()  # inline until the retry delay passes
+		broken_executor.shutdown.assert_called_once_with(wait=False)
+
+
+
+class MicroBatchTests(TestCase):
+
+	def setUp(self):
+		self.posts = []
+		patchers = [
+			mock.patch.object(micro_batch, 'enabled_calcs', ['opera']),
+			mock.patch.object(micro_batch, 'bulk_adapters', {'opera': micro_batch.OperaBulkAdapter("http://opera/bulk")}),
+			mock.patch.object(micro_batch, '_batchers', OrderedDict()),
+			mock.patch.object(micro_batch.requests, 'post', side_effect=self.bulk_post),
+		]
+		for patcher in patchers:
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+	def bulk_post(self, url, json=None, timeout=None):
+		self.posts.append(json)
+		response = mock.Mock()
+		response.json.return_value = {'data': [{'valid': True, 'data': len(chemical)} for chemical in json['chemicals']]}
+		return response
+
+	def backend_request(self, chemical, prop="water_sol"):
+		request_dict = {'chemical': chemical, 'calc': "opera", 'prop': prop, 'run_type': "rest"}
+		return CTS_REST().backendRequest('opera', mock.Mock(spec=[]), request_dict)
+
+	def test_concurrent_requests_share_one_post(self):
+		chemicals = ["C", "CC", "CCC"]
+		results = {}
+		def _request(chemical):
+			results[chemical] = self.backend_request(chemical)
+		with mock.patch.object(micro_batch, 'batch_window', 60), mock.patch.object(micro_batch, 'batch_max_size', 3):
+			threads = [threading.Thread(target=_request, args=(chemical,)) for chemical in chemicals]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join(5)
+		self.assertEqual(len(self.posts), 1)
+		self.assertEqual(sorted(self.posts[0]['chemicals']), chemicals)
+		self.assertEqual(self.posts[0]['prop'], "water_sol")
+		for chemical in chemicals:
+			self.assertEqual(results[chemical]['data'], len(chemical))
+			self.assertEqual(results[chemical]['request_post']['chemical'], chemical)
+
+	def test_batcher_map_is_bounded(self):
+		with mock.patch.object(micro_batch, 'batch_max_size', 1), mock.patch.object(micro_batch, 'max_groups', 2):
+			for prop in ["water_sol", "kow_no_ph", "koc"]:
+				self.assertEqual(self.backend_request("CC", prop)['data'], 2)
+		self.assertEqual(len(self.posts), 3)
+		self.assertEqual(len(micro_batch._batchers), 2)
+
+	def test_unbatched_calcs_call_backend(self):
+		calc_obj = mock.Mock(spec=['data_request_handler'])
+		calc_obj.data_request_handler.return_value = {'valid': True, 'data': 1.0}
+		self.assertEqual(CTS_REST().backendRequest('chemaxon', calc_obj, {'chemical': "CC"})['data'], 1.0)
+		self.assertEqual(self.posts, [])
+
+
+
+class RequestTimingTests(TestCase):
+
+	def setUp(self):
+		self.factory = RequestFactory()
+		self.tmp_dir = tempfile.TemporaryDirectory()
+		self.addCleanup(self.tmp_dir.cleanup)
+		patchers = [
+			mock.patch.object(request_timing, 'profile_token', "secret"),
+			mock.patch.object(request_timing, 'profile_dir', self.tmp_dir.name),
+		]
+		for patcher in patchers:
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+	@staticmethod
+	@request_timing.timed_request
+	def view(request):
+		with request_timing.phase('backend'):
+			time.sleep(0.01)
+		return HttpResponse("{}")
+
+	def test_server_timing(self):
+		response = self.view(self.factory.get("/chemaxon/run"))
+		phases = dict(item.split(';dur=') for item in response['Server-Timing'].split(', '))
+		self.assertEqual(list(phases), ['backend', 'total'])
+		self.assertGreaterEqual(float(phases['backend']), 10.0)
+		self.assertIsNone(request_timing.current_timer())
+
+	def test_profiles_with_token_only(self):
+		for headers in [{}, {'HTTP_X_CTS_PROFILE': "wrong"}, {'HTTP_X_CTS_PROFILE': ""}]:
+			response = self.view(self.factory.get("/chemaxon/run", **headers))
+			self.assertFalse(response.has_header('X-CTS-Profile-Id'), headers)
+		self.assertEqual(os.listdir(self.tmp_dir.name), [])
+
+		response = self.view(self.factory.get("/chemaxon/run", HTTP_X_CTS_PROFILE="secret"))
+		profile_id = response['X-CTS-Profile-Id']
+		self.assertEqual(os.listdir(self.tmp_dir.name), ["{}.collapsed".format(profile_id)])
+
+	def test_no_profiling_without_configured_token(self):
+		with mock.patch.object(request_timing, 'profile_token', ""):
+			response = self.view(self.factory.get("/chemaxon/run", HTTP_X_CTS_PROFILE=""))
+		self.assertFalse(response.has_header('X-CTS-Profile-Id'))
+
+	def test_logs_slow_requests(self):
+		with mock.patch.object(request_timing, 'slow_request_ms', 0), mock.patch.object(request_timing, 'slow_request_sample', 1.0):
+			with self.assertLogs(level='WARNING') as logs:
+				self.view(self.factory.get("/chemaxon/run"))
+		self.assertIn("slow request GET /chemaxon/run", logs.output[0])
+		self.assertIn("backend;dur=", logs.output[0])
+
+	def test_worker_thread_phases(self):
+		from concurrent.futures import ThreadPoolExecutor
+		def _work(i):
+			with request_timing.phase('worker'):
+				return i
+		@request_timing.timed_request
+		def view(request):
+			with ThreadPoolExecutor(max_workers=2) as executor:
+				list(executor.map(request_timing.with_current_timer(_work), range(4)))
+			return HttpResponse("{}")
+		self.assertIn("worker;dur=", view(self.factory.get("/consensus"))['Server-Timing'])
+
+
+
+class HealthTests(TestCase):
+
+	def setUp(self):
+		self.client = Client()
+		patchers = [
+			mock.patch.object(health, 'start_prober'),
+			mock.patch.object(health, '_snapshot', None),
+			mock.patch.dict('os.environ', {'CTS_JCHEM_SERVER': "jchem", 'CTS_OPERA_SERVER': "opera"}),
+		]
+		for patcher in patchers:
+			patcher.start()
+			self.addCleanup(patcher.stop)
+		for env_var in health.backend_servers.values():
+			if env_var not in ['CTS_JCHEM_SERVER', 'CTS_OPERA_SERVER']:
+				os.environ.pop(env_var, None)  # restored by patch.dict
+
+	def probe(self, down=(), mongo_ok=True):
+		probe_http = lambda server: (server not in down, 1.0, None if server not in down else "refused")
+		with mock.patch.object(health, 'probe_http', side_effect=probe_http), \
+				mock.patch.object(health, 'probe_mongo', return_value=(mongo_ok, 1.0, None)):
+			health._snapshot = health.probe_backends()
+
+	def get(self, calc=None):
+		response = self.client.get("/health", {'calc': calc} if calc else {})
+		return response.status_code, json.loads(response.content)
+
+	def test_starting(self):
+		self.assertEqual(self.get(), (503, {'status': "starting"}))
+		health.start_prober.assert_called_once()
+
+	def test_calc_readiness(self):
+		self.probe(down=["opera"])
+		self.assertEqual(self.get('chemaxon')[0], 200)
+		status, health_obj = self.get('opera')
+		self.assertEqual(status, 503)
+		self.assertEqual(health_obj['calcs']['opera']['status'], "degraded")
+		self.assertEqual(self.get('sparc')[0], 503)  # no server configured
+		self.assertEqual(self.get('nope')[0], 503)
+
+	def test_overall_readiness_follows_mongo(self):
+		self.probe(down=["opera"])
+		status, health_obj = self.get()
+		self.assertEqual((status, health_obj['status']), (200, "degraded"))
+		self.probe(mongo_ok=False)
+		self.assertEqual(self.get()[0], 503)
+
+	def test_unconfigured_backends_not_degraded(self):
+		self.probe()
+		status, health_obj = self.get()
+		self.assertEqual(health_obj['status'], "ok")
+		self.assertEqual(health_obj['backends']['sparc']['status'], "unconfigured")
+		self.assertEqual(health_obj['calcs']['sparc']['status'], "unconfigured")
+		self.assertEqual(health_obj['calcs']['opera']['status'], "ok")
+
+	def test_stale_snapshot_not_ready(self):
+		self.probe()
+		health._snapshot['timestamp'] -= health.stale_after + 1
+		status, health_obj = self.get('chemaxon')
+		self.assertEqual((status, health_obj['status']), (503, "stale"))
+		self.assertEqual(self.get()[0], 503)
@@ -10,6 +10,9 @@ urlpatterns = [
 
 urlpatterns += [
 	path('', views.showSwaggerPage),
+	path('health', views.getHealth),
+	path('export', views.exportPchem),
+	path('consensus', views.getConsensus),
 	path('swag', views.getSwaggerJsonContent),
 	path('molecule', views.get_chem_info),
 	path('<str:calc>/inputs', views.getCalcInputs),
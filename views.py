@@ -4,15 +4,21 @@ CTS REST URLs - Swagger UI
 """
 
 from cts_app.cts_api import cts_rest
+from cts_app.cts_api import http_cache
+from cts_app.cts_api import health
+from cts_app.cts_api import pchem_export
+from cts_app.cts_api import consensus
+from cts_app.cts_api.structure_index import is_cacheable_result
+from cts_app.cts_api.request_decoding import parse_body, decode_run_request, decode_molecule_request, decode_batch_request, validate_run_params, validate_inputs_params, RequestValidationError
+from cts_app.cts_api.request_timing import timed_request, phase
 from django.views.decorators.csrf import csrf_exempt
-from django.http import HttpRequest, HttpResponse
+from django.http import HttpRequest, HttpResponse, HttpResponseNotModified, HttpResponsePermanentRedirect, StreamingHttpResponse
 from django.template.loader import render_to_string
 from django.shortcuts import render
 import json
 from django.conf import settings
 import logging
 import os
-import bleach
 
 
 root_path = os.path.abspath(os.path.dirname(__file__))
@@ -73,6 +79,18 @@ def getCTSEndpoints(request):
 
 
 
+@csrf_exempt
+def getHealth(request):
+	"""
+	Health/readiness check from the background backend
+	probe snapshot, e.g., /health or /health?calc=opera.
+	Returns 503 if not ready.
+	"""
+	health_obj, ready = health.get_health(request.GET.get('calc'))
+	return HttpResponse(json.dumps(health_obj), content_type='application/json', status=200 if ready else 503)
+
+
+
 @csrf_exempt
 def getCalcEndpoints(request, endpoint=None):
 
@@ -106,9 +124,15 @@ def getCalcInputs(request, calc=None):
 
 
 @csrf_exempt
+@timed_request
 def runCalc(request, calc=None):
-	request_params = smiles_backslash_fix_for_swagger(request)
-	request_params = bleach_request(request_params)
+	if request.method == "GET":
+		return runCalcGet(request, calc)
+	try:
+		with phase('decode'):
+			request_params = decode_run_request(request, calc)
+	except RequestValidationError as e:
+		return HttpResponse(json.dumps({'error': "{}".format(e)}), content_type='application/json', status=400)
 	try:
 		return cts_rest.CTS_REST().runCalc(calc, request_params)
 	except Exception as e:
@@ -118,41 +142,157 @@ def runCalc(request, calc=None):
 
 
 
+def runCalcGet(request, calc=None):
+	"""
+	Idempotent, cacheable GET form of runCalc, e.g.,
+	GET /chemaxon/run?chemical=CCC&prop=water_sol
+	"""
+	request_params, query = http_cache.canonical_query(request.GET)
+	if request.META.get('QUERY_STRING', '') != query:
+		# one URL per request for CDN/browser caches:
+		return HttpResponsePermanentRedirect("{}?{}".format(request.path, query))
+
+	etag = http_cache.get_etag(calc, query)
+	if etag and http_cache.if_none_match(request, etag):
+		return not_modified_response(calc, etag)
+
+	try:
+		request_params = validate_run_params(request_params, calc)
+	except RequestValidationError as e:
+		return HttpResponse(json.dumps({'error': "{}".format(e)}), content_type='application/json', status=400)
+
+	cts_obj = cts_rest.CTS_REST()
+	model_version = cts_obj.getModelVersion(calc)
+	if request.META.get('HTTP_IF_NONE_MATCH'):
+		etag = http_cache.stored_result_etag(cts_rest.run_calc_names.get(calc, calc), request_params, model_version)
+		if etag and http_cache.if_none_match(request, etag):
+			http_cache.set_etag(calc, query, etag)
+			return not_modified_response(calc, etag)
+
+	try:
+		response = cts_obj.runCalc(calc, request_params)
+	except Exception as e:
+		logging.warning("exception at cts_api views runCalcGet: {}".format(e))
+		response = HttpResponse(json.dumps({'error': "Error requesting data from {}".format(calc)}), content_type='application/json')
+
+	result_data = None
+	if not response.streaming and response.status_code == 200:
+		result_data = http_cache.response_result(response.content)
+	if not is_cacheable_result(result_data):
+		# errors and invalid calc results (valid/status false) aren't cached:
+		response['Cache-Control'] = "no-store"
+		return response
+
+	etag = http_cache.result_etag(result_data, model_version)
+	http_cache.set_etag(calc, query, etag)
+	if http_cache.if_none_match(request, etag):
+		return not_modified_response(calc, etag)
+	response['ETag'] = etag
+	response['Cache-Control'] = http_cache.cache_control(calc)
+	return response
+
+
+
+def not_modified_response(calc, etag):
+	response = HttpResponseNotModified()
+	response['ETag'] = etag
+	response['Cache-Control'] = http_cache.cache_control(calc)
+	return response
+
+
+
 @csrf_exempt
-def get_chem_info(request):
+def exportPchem(request):
+	"""
+	Streams batch p-chem as CSV, Arrow, or Parquet. Request body:
+	{'chemicals': [...], 'calcs': [...], 'props': [...], 'format': "csv", 'ph': 7.0}
+	"""
+	try:
+		request_params = decode_batch_request(request)
+		export_format = request_params.get('format') or 'csv'
+		if export_format != 'csv' and not pchem_export.arrow_available():
+			raise RequestValidationError("{} export requires pyarrow".format(export_format))
+	except RequestValidationError as e:
+		return HttpResponse(json.dumps({'error': "{}".format(e)}), content_type='application/json', status=400)
+
+	cts_obj = cts_rest.CTS_REST()
+	schema = pchem_export.export_schema(cts_obj, request_params.get('calcs') or cts_obj.calcs, request_params.get('props'))
+	rows = pchem_export.iter_export_rows(cts_obj, request_params['chemicals'], schema, request_params.get('ph'))
+	response = StreamingHttpResponse(pchem_export.stream_export(rows, export_format), content_type=pchem_export.export_formats[export_format])
+	response['Content-Disposition'] = 'attachment; filename="cts_pchem.{}"'.format(export_format)
+	return response
 
-	request_post = {}
-	if 'message' in request.POST:
-		# accounts for request from nodejs (e.g., cts_stress)
-		request_post = json.loads(request.POST.get('message'))
-	else:
-		request_post = request.POST
 
-	if len(request_post) < 1 and len(request.body) > 1:
-		# accounts for request being in body (e.g., postman)
-		request_post = json.loads(request.body.decode('utf-8'))
 
-	request_post = bleach_request(request_post)
+@csrf_exempt
+@timed_request
+def getConsensus(request):
+	"""
+	Cross-calculator consensus stats for a batch. Request body:
+	{'chemicals': [...], 'props': [...], 'calcs': [...], 'ph': 7.0, 'aggregatesOnly': false}
+	"""
+	try:
+		request_params = decode_batch_request(request, ['chemicals', 'props'])
+	except RequestValidationError as e:
+		return HttpResponse(json.dumps({'error': "{}".format(e)}), content_type='application/json', status=400)
+
+	try:
+		results = consensus.run_consensus(
+			cts_rest.CTS_REST(),
+			request_params['chemicals'],
+			request_params['props'],
+			request_params.get('calcs'),
+			request_params.get('ph'),
+			bool(request_params.get('aggregatesOnly'))
+		)
+	except Exception as e:
+		logging.warning("exception at cts_api views getConsensus: {}".format(e))
+		return HttpResponse(json.dumps({'error': "Error getting consensus data"}), content_type='application/json')
+	return HttpResponse(json.dumps({'status': True, 'data': results}), content_type='application/json')
+
+
+
+@csrf_exempt
+@timed_request
+def get_chem_info(request):
+	try:
+		with phase('decode'):
+			request_post = decode_molecule_request(request)
+	except RequestValidationError as e:
+		return HttpResponse(json.dumps({'error': "{}".format(e)}), content_type='application/json', status=400)
 
 	try:
 		return cts_rest.getChemicalEditorData(request_post)
 	except Exception as e:
 		logging.warning("cts rest exception: {}".format(e))
-		return HttpResponse(json.dumps({'error": "Error getting chemical information'}))
+		return HttpResponse(json.dumps({'error': "Error getting chemical information"}), content_type='application/json')
 
 
 
 @csrf_exempt
+@timed_request
 def cts_rest_proxy(request):
 	"""
 	CTS API v2 entry point.
 	"""
-	request_params = smiles_backslash_fix_for_swagger(request)
+	try:
+		with phase('decode'):
+			if request.method == "GET":
+				request_params = validate_inputs_params(request.GET.dict())
+				calc = request_params['calc']
+			else:
+				request_params = parse_body(request)
+				calc = request_params.get('calc')
+				if not calc:
+					raise RequestValidationError("missing required input: calc")
+				request_params = validate_run_params(request_params, calc)
+	except RequestValidationError as e:
+		return HttpResponse(json.dumps({'error': "{}".format(e)}), content_type='application/json', status=400)
 
 	if request.method == "GET":
 		# handle get request (return calc info)
 		try:
-			return cts_rest.CTS_REST().getCalcInputs(request_params['chemical'], request_params['calc'], request_params['prop'])
+			return cts_rest.CTS_REST().getCalcInputs(request_params.get('chemical'), calc, request_params.get('prop'))
 		except Exception as e:
 			return HttpResponse(json.dumps({'error': "{}".format(e)}), content_type='application/json')
 
@@ -163,40 +303,3 @@ def cts_rest_proxy(request):
 		except Exception as e:
 			logging.warning("exception: {}".format(e))
 			return HttpResponse(json.dumps({'error': "Error requesting data from {}".format(calc)}), content_type='application/json')
-
-
-
-def smiles_backslash_fix_for_swagger(request):
-	"""
-	Workaround for backslash encoding issue that occurs when using
-	Swagger API docs.
-	"""
-	try:
-		request_body = request.body
-		request_params = json.loads(request_body)
-	except ValueError as ve:
-		# swagger api issue with not encoding backslash in smiles properly
-		logging.warning("trouble converting request body to json obj, checking for backslashes in smiles..")
-		request_string = str(request_body, 'utf-8')
-		if '\\' in request_string:
-			logging.warning("backslash found, temporarily replacing with '_', parsing, then re-replacing..")
-			request_string = request_string.replace('\\', '_')  # temp replace backslash for json parse
-			request_params = json.loads(request_string)
-			request_params['chemical'] = request_params['chemical'].replace('_', '\\')  # put backslash back
-		else:
-			request_params = request.POST
-
-	return request_params
-
-
-def bleach_request(request_post):
-	"""
-	Loops request key:vals and sanitizes them with bleach.
-	"""
-	bleached_request = {}
-	for key, val in request_post.items():
-		if type(val) == str:
-			bleached_request[key] = bleach.clean(val)
-		else:
-			bleached_request[key] = val
-	return bleached_request